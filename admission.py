@@ -0,0 +1,96 @@
+"""Admission control and per-request deadlines.
+
+Requests are shed with a fast 503 rather than queued for clients that have
+given up, and admitted ones get an overall time budget that database reads
+and upstream calls spend through time_left().
+"""
+import threading
+import time
+
+from flask import g, has_request_context
+
+from metrics import REQUEST_QUEUE_TIME, REQUESTS_IN_FLIGHT
+
+
+def parse_request_start(value):
+    """Epoch seconds from an X-Request-Start header, or None.
+
+    Accepts ``t=<value>`` or a bare number in seconds, milliseconds or
+    microseconds, which covers what ALBs, nginx and HAProxy are set up to send.
+    """
+    if not value:
+        return None
+    try:
+        stamp = float(value.strip().removeprefix("t="))
+    except ValueError:
+        return None
+    if stamp > 1e14:
+        return stamp / 1e6
+    if stamp > 1e11:
+        return stamp / 1e3
+    return stamp
+
+
+def parse_amzn_trace_start(value):
+    """Epoch seconds at which an AWS load balancer received the request, or None.
+
+    ALBs cannot add X-Request-Start, but they stamp every request with
+    X-Amzn-Trace-Id, whose ``Self`` (or, when the ALB created the header,
+    ``Root``) field holds the arrival time as hex epoch seconds:
+    ``Root=1-67a1b2c3-...``. The resolution is one second, so this returns
+    the middle of that second.
+    """
+    if not value:
+        return None
+    fields = dict(part.strip().partition("=")[::2] for part in value.split(";"))
+    # A client-supplied header keeps its Root; Self is the ALB's own segment
+    trace_id = fields.get("Self") or fields.get("Root") or ""
+    parts = trace_id.split("-")
+    if len(parts) != 3 or parts[0] != "1" or len(parts[1]) != 8:
+        return None
+    try:
+        return int(parts[1], 16) + 0.5
+    except ValueError:
+        return None
+
+
+class AdmissionController:
+    """Per-process cap on in-flight requests and on time spent queued.
+
+    With sync workers a process only ever has one request in flight, so
+    the queue-time deadline does the shedding there; the in-flight cap
+    matters for gevent workers.
+    """
+
+    def __init__(self, max_in_flight, max_queue_seconds):
+        self.max_in_flight = max_in_flight
+        self.max_queue_seconds = max_queue_seconds
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def admit(self, request_start):
+        """Return None if the request may proceed, else the shed reason."""
+        if request_start is not None:
+            queued = max(0.0, time.time() - request_start)
+            REQUEST_QUEUE_TIME.observe(queued)
+            if self.max_queue_seconds and queued > self.max_queue_seconds:
+                return "queue_timeout"
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return "in_flight"
+            self.in_flight += 1
+        REQUESTS_IN_FLIGHT.inc()
+        return None
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+        REQUESTS_IN_FLIGHT.dec()
+
+
+def time_left(limit):
+    """Seconds until ``limit`` or the current request's deadline, whichever is sooner."""
+    deadline = g.get("deadline") if has_request_context() else None
+    if deadline is None:
+        return limit
+    return min(limit, deadline - time.time())
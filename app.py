@@ -1,175 +1,467 @@
+import atexit
+import functools
+import hashlib
+import hmac
+import json
 import logging
+import math
 import os
+import re
 import time
+import uuid
 from datetime import datetime
 
-import boto3
-from botocore.exceptions import ClientError
 from dotenv import load_dotenv
-from flask import Flask, request, render_template, jsonify
-import mysql.connector
-from mysql.connector import Error
-from prometheus_client import (
-    Counter, Histogram, Gauge, generate_latest,
-    CollectorRegistry, CONTENT_TYPE_LATEST, make_wsgi_app
-)
-import requests
-from werkzeug.middleware.dispatcher import DispatcherMiddleware
-
-app = Flask(__name__)
-
-# Configure structured logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
 
-# Prometheus Metrics
-registry = CollectorRegistry()
+# The modules below read their settings at import, so .env has to be loaded first
+load_dotenv()
 
-REQUEST_COUNT = Counter(
-    'weather_requests_total', 'Total weather requests',
-    ['method', 'endpoint', 'status'], registry=registry
-)
-REQUEST_DURATION = Histogram(
-    'weather_request_duration_seconds', 'Request duration', registry=registry
-)
-ACTIVE_CONNECTIONS = Gauge(
-    'weather_active_connections', 'Active database connections', registry=registry
+# pylint: disable=wrong-import-position
+from botocore.exceptions import ClientError
+from flask import Flask, request, render_template, jsonify, g, make_response, url_for
+from markupsafe import Markup
+from mysql.connector import Error
+import requests
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional fast JSON encoder
+    orjson = None
+
+from admission import AdmissionController, parse_amzn_trace_start, parse_request_start
+from caches import RenderCache, WeatherCache
+from cloudwatch import put_custom_metric, stop_publishing
+from compression import CompressionMiddleware
+from db import (
+    bounded_select, db_error_operation, get_db_connection, init_db, probe_database,
+    release_db_connection
 )
-API_RESPONSE_TIME = Histogram(
-    'weather_api_response_time_seconds', 'Weather API response time', registry=registry
+from health import DependencyCheck, HealthChecker, readiness
+from heavy_hitters import HeavyHitters, SharedHeavyHitters
+from history import (
+    HISTORY_MAX_PAGE_SIZE, fetch_recent_history, history_page, is_poison_row_error,
+    latest_history_id, parse_history_cursor, write_history_rows
 )
-WEATHER_QUERIES = Counter(
-    'weather_queries_total', 'Total weather queries',
-    ['city', 'status'], registry=registry
+from logging_setup import configure_logging
+from metrics import (
+    DATABASE_QUERIES, RATE_LIMITED, REQUEST_COUNT, REQUEST_DURATION, REQUEST_DURATION_HIGHRES,
+    REQUESTS_SHED, RESPONSE_COMPRESSION, SPOOL_BYTES, SPOOL_OLDEST_AGE, SPOOL_ROWS,
+    WEATHER_QUERIES, metrics_exposition
 )
-DATABASE_QUERIES = Counter(
-    'database_queries_total', 'Total database queries',
-    ['operation'], registry=registry
+from profiler import StackSampler, write_profile
+from rate_limit import InMemoryBuckets, SharedMemoryBuckets
+from spool import DiskSpool, SpoolReplayer
+from static_assets import AssetManifest, StaticAssets
+from tracing import (
+    finish_trace, server_timing_header, start_trace, timed_phase, trace_exemplar, trace_span,
+    traced
 )
+from upstream import API_KEY, fetch_weather_from_api, probe_weather_api
+# pylint: enable=wrong-import-position
 
-# CloudWatch client for custom metrics
-cloudwatch = boto3.client('cloudwatch', region_name=os.getenv('AWS_REGION', 'us-east-1'))
+app = Flask(__name__)
 
-# Weather API Setup
-load_dotenv()
+# Structured logging, written by a listener thread (see logging_setup.py)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json').lower()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Per-logger sampling of INFO-and-below records, e.g. "app=0.1,werkzeug=0.01"
+LOG_SAMPLE_RATES = {
+    name.strip(): float(rate)
+    for name, _, rate in (item.partition('=') for item in os.getenv('LOG_SAMPLE_RATES', '').split(','))
+    if name.strip() and rate
+}
 
-API_KEY = os.getenv("WEATHER_API_KEY")
-BASE_URL = "http://api.weatherapi.com/v1/current.json"
+log_listener = configure_logging(LOG_LEVEL, LOG_FORMAT, LOG_QUEUE_SIZE, LOG_SAMPLE_RATES)
+atexit.register(log_listener.stop)
+# Registered after the log listener, so it runs first and its errors are logged
+atexit.register(stop_publishing)
+logger = logging.getLogger(__name__)
+
+# Upstream observations are refreshed every 15 minutes or so; reuse them
+WEATHER_CACHE_SECONDS = int(os.getenv("WEATHER_CACHE_SECONDS", "300"))
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", "1024"))
+
+# Only the most queried cities get their own weather_queries_total label value
+CITY_LABEL_TOP_K = int(os.getenv("CITY_LABEL_TOP_K", "50"))
+# 'shm' ranks cities across every worker on the node, 'memory' per worker
+CITY_LABEL_BACKEND = os.getenv("CITY_LABEL_BACKEND", "shm").lower()
+CITY_LABEL_SHM_PATH = os.getenv("CITY_LABEL_SHM_PATH", "/dev/shm/weather-app-cities"
+                                if os.path.isdir("/dev/shm") else "/tmp/weather-app-cities")
+OTHER_CITY_LABEL = "other"
+
+# Report per-phase request timings to browsers in a Server-Timing header
+SERVER_TIMING_ENABLED = os.getenv("SERVER_TIMING_ENABLED", "true").lower() == "true"
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "2.0"))
+
+# Response compression; bodies smaller than this go out uncompressed
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", "5"))
+COMPRESS_CACHE_SIZE = int(os.getenv("COMPRESS_CACHE_SIZE", "64"))
+
+# Background dependency checks behind /health, /readyz and /livez. The
+# upstream is probed far less often than the database because every pod
+# shares it and each probe spends API quota.
+HEALTH_DB_INTERVAL = float(os.getenv("HEALTH_DB_INTERVAL", "15"))
+HEALTH_API_INTERVAL = float(os.getenv("HEALTH_API_INTERVAL", "300"))
+HEALTH_SPOOL_INTERVAL = float(os.getenv("HEALTH_SPOOL_INTERVAL", "5"))
+HEALTH_FAILURE_THRESHOLD = int(os.getenv("HEALTH_FAILURE_THRESHOLD", "3"))
+
+# Admission control: shed load with a fast 503 rather than queueing work for
+# clients that have given up. 0 disables either check. Queue time is measured
+# from the load balancer's arrival stamp, since a sync worker never sees the
+# requests waiting in its listen backlog; without one only the in-flight cap
+# applies.
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "200"))
+ADMISSION_MAX_QUEUE_SECONDS = float(os.getenv("ADMISSION_MAX_QUEUE_SECONDS", "10"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "2"))
+ADMISSION_EXEMPT_ENDPOINTS = {"metrics", "livez", "readyz", "health", "static"}
+
+# Per-client token buckets in front of the views that call the weather API.
+# "shm" shares buckets between the workers on a node; "memory" is per process.
+# RATE_LIMIT_KEY_HEADER should only name a header a trusted proxy sets.
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "30"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "shm").lower()
+RATE_LIMIT_SHM_PATH = os.getenv("RATE_LIMIT_SHM_PATH", "/dev/shm/weather-app-ratelimit"
+                                if os.path.isdir("/dev/shm") else "/tmp/weather-app-ratelimit")
+RATE_LIMIT_SLOTS = int(os.getenv("RATE_LIMIT_SLOTS", "65536"))
+RATE_LIMIT_KEY_HEADER = os.getenv("RATE_LIMIT_KEY_HEADER")
+RATE_LIMIT_PROXY_HOPS = int(os.getenv("RATE_LIMIT_PROXY_HOPS", "1"))
+
+# Every request gets an overall time budget, counted from the load balancer's
+# arrival stamp when present; database reads and weather API calls spend what
+# is left of it through admission.time_left().
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "20"))
+
+# History rows that cannot be written while MySQL is down or slow go to a
+# local spool and are replayed in batches once the database is healthy
+SPOOL_ENABLED = os.getenv("SPOOL_ENABLED", "true").lower() == "true"
+SPOOL_DIR = os.getenv("SPOOL_DIR", "/tmp/weather-app-spool")
+SPOOL_FSYNC_INTERVAL = float(os.getenv("SPOOL_FSYNC_INTERVAL", "0.05"))
+SPOOL_REPLAY_INTERVAL = float(os.getenv("SPOOL_REPLAY_INTERVAL", "5"))
+SPOOL_REPLAY_BATCH = int(os.getenv("SPOOL_REPLAY_BATCH", "500"))
+# Stay well inside the pod's spool volume; a full spool takes the pod out of rotation
+SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(256 * 1024 * 1024)))
+
+def template_version(*names):
+    """Short digest of the given templates, used to version cached pages."""
+    digest = hashlib.sha1()
+    for name in names:
+        with open(os.path.join(app.root_path, "templates", name), "rb") as handle:
+            digest.update(handle.read())
+    return digest.hexdigest()[:12]
+
+# Fingerprinted assets built by static_assets.py; ASSET_BASE_URL may point at a CDN
+STATIC_DIST_DIR = os.path.join(app.static_folder, "dist")
+asset_manifest = AssetManifest(os.path.join(STATIC_DIST_DIR, "manifest.json"),
+                               os.getenv("ASSET_BASE_URL", "/static/dist/"))
+# Per-worker memory for asset bodies; larger files are sent from disk
+STATIC_MEMORY_BYTES = int(os.getenv("STATIC_MEMORY_BYTES", str(64 * 1024 * 1024)))
+
+@app.context_processor
+def asset_helpers():
+    def asset_url(name):
+        return asset_manifest.url(name) or url_for('static', filename=name)
+    return {"asset_url": asset_url, "image_sources": asset_manifest.sources}
+
+# Rendered pages are only valid for the templates they came from
+TEMPLATE_VERSION = template_version("index.html", "history_table.html")
+
+# Shared secret for the /admin and /debug endpoints; unset disables them
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Sampling profiler: POST /debug/profile starts an on-demand profile whose
+# result is written to PROFILE_DIR; continuous mode writes a low-rate
+# collapsed-stack profile of this worker there every window. Under gevent
+# the rate is capped at PROFILE_GREENLET_MAX_HZ (see profiler.py).
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "30"))
+PROFILE_GREENLET_MAX_HZ = float(os.getenv("PROFILE_GREENLET_MAX_HZ", "10"))
+PROFILE_CONTINUOUS = os.getenv("PROFILE_CONTINUOUS", "false").lower() == "true"
+PROFILE_CONTINUOUS_HZ = float(os.getenv("PROFILE_CONTINUOUS_HZ", "5"))
+PROFILE_INTERVAL = int(os.getenv("PROFILE_INTERVAL", "60"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/weather-profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "60"))
 
 # Validate API key is set
 if not API_KEY:
     logger.error("WEATHER_API_KEY environment variable is not set!")
 
-# MySQL connection with connection pooling
-db_config = {
-    'host': os.getenv("DB_HOST"),
-    'user': os.getenv("DB_USER"),
-    'password': os.getenv("DB_PASSWORD"),
-    'database': os.getenv("DB_NAME"),
-    'pool_name': 'weather_app_pool',
-    'pool_size': 5,
-    'pool_reset_session': True
-}
-
-def get_db_connection():
-    try:
-        conn = mysql.connector.connect(**db_config)
-        ACTIVE_CONNECTIONS.inc()
-        DATABASE_QUERIES.labels(operation='connect').inc()
-        return conn
-    except Error as err:
-        logger.error("Database connection error: %s", err)
-        DATABASE_QUERIES.labels(operation='connect_error').inc()
-        raise
-
-def release_db_connection(conn):
-    try:
-        if conn.is_connected():
-            conn.close()
-            ACTIVE_CONNECTIONS.dec()
-            DATABASE_QUERIES.labels(operation='disconnect').inc()
-    except Error as err:
-        logger.error("Error closing database connection: %s", err)
-        DATABASE_QUERIES.labels(operation='disconnect_error').inc()
-
-def init_db():
-    """Initialize database schema."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS weather_history (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                city VARCHAR(255) NOT NULL,
-                temperature VARCHAR(50),
-                description VARCHAR(255),
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
-        cursor.close()
-        logger.info("Database schema initialized.")
-    except Error as err:
-        logger.error("Failed to initialize database: %s", err)
-    finally:
-        if conn:
-            release_db_connection(conn)
+def require_admin_token(view):
+    """Restrict a view to callers presenting ADMIN_TOKEN in X-Admin-Token."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({"error": "Not found"}), 404
+        supplied = request.headers.get("X-Admin-Token", "")
+        if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({"error": "Forbidden"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+def make_rate_limiter():
+    """Build the configured bucket store, or None when limiting is off."""
+    if RATE_LIMIT_PER_MINUTE <= 0:
+        return None
+    rate = RATE_LIMIT_PER_MINUTE / 60.0
+    if RATE_LIMIT_BACKEND == "shm":
+        try:
+            return SharedMemoryBuckets(RATE_LIMIT_SHM_PATH, rate, RATE_LIMIT_BURST,
+                                       RATE_LIMIT_SLOTS)
+        except OSError as err:
+            logger.error("Shared rate limit table unavailable, using per-process buckets: %s",
+                         err)
+    elif RATE_LIMIT_BACKEND != "memory":
+        logger.error("Unknown RATE_LIMIT_BACKEND %r, using per-process buckets",
+                     RATE_LIMIT_BACKEND)
+    return InMemoryBuckets(rate, RATE_LIMIT_BURST)
+
+rate_limiter = make_rate_limiter()
+
+def client_key():
+    """Identify the caller by the trusted key header or by client IP."""
+    if RATE_LIMIT_KEY_HEADER:
+        value = request.headers.get(RATE_LIMIT_KEY_HEADER)
+        if value:
+            return f"key:{value}"
+    # Each proxy appends the address it saw, so count back past our own hops
+    forwarded = [hop.strip() for hop in request.headers.get("X-Forwarded-For", "").split(",")
+                 if hop.strip()]
+    if RATE_LIMIT_PROXY_HOPS and len(forwarded) >= RATE_LIMIT_PROXY_HOPS:
+        return f"ip:{forwarded[-RATE_LIMIT_PROXY_HOPS]}"
+    return f"ip:{request.remote_addr}"
+
+class RateLimitExceeded(Exception):
+    """The caller's token bucket is empty; answered with a 429 and Retry-After."""
+
+    def __init__(self, retry_after):
+        super().__init__("Too many requests")
+        self.retry_after = retry_after
+
+def charge_rate_limit():
+    """Take a token from the caller's bucket or raise RateLimitExceeded."""
+    if rate_limiter is None:
+        return
+    allowed, retry_after = rate_limiter.consume(client_key())
+    if not allowed:
+        RATE_LIMITED.labels(endpoint=request.endpoint or 'unknown').inc()
+        raise RateLimitExceeded(retry_after)
+
+@app.errorhandler(RateLimitExceeded)
+def rate_limit_exceeded(err):
+    return json_response({"error": "Too many requests"}, 429,
+                         headers={"Retry-After": str(max(1, round(err.retry_after)))})
+
+def write_continuous_profile(counts):
+    write_profile(PROFILE_DIR, f"profile-{os.getpid()}-{int(time.time())}.folded", counts,
+                  f"profile-{os.getpid()}-", PROFILE_KEEP)
+
+stack_sampler = StackSampler(PROFILE_GREENLET_MAX_HZ)
+if PROFILE_CONTINUOUS:
+    stack_sampler.set_continuous(PROFILE_INTERVAL, PROFILE_CONTINUOUS_HZ,
+                                 write_continuous_profile)
+stack_sampler.ensure_started()
 
 # Initialize DB immediately (Force Rebuild)
 init_db()
 
-def put_custom_metric(metric_name, value, unit='Count'):
-    try:
-        cloudwatch.put_metric_data(
-            Namespace='WeatherApp',
-            MetricData=[
-                {
-                    'MetricName': metric_name,
-                    'Value': value,
-                    'Unit': unit,
-                    'Timestamp': datetime.utcnow()
-                }
-            ]
-        )
-    except Exception as err:
-        logger.error("Failed to put custom metric %s: %s", metric_name, err)
+history_spool = (DiskSpool(SPOOL_DIR, SPOOL_FSYNC_INTERVAL, max_bytes=SPOOL_MAX_BYTES)
+                 if SPOOL_ENABLED else None)
+if history_spool is not None:
+    atexit.register(history_spool.close)
 
+def spool_history_row(row):
+    """Keep a row on local disk for the replayer; False if that fails too."""
+    if history_spool is None:
+        return False
+    try:
+        history_spool.append(row)
+    except OSError as err:
+        logger.error("Could not spool history row: %s", err)
+        SPOOL_ROWS.labels(result='failed').inc()
+        return False
+    SPOOL_ROWS.labels(result='spooled').inc()
+    spool_replayer.ensure_started()
+    return True
+
+@traced('save_weather_data')
 def save_weather_data(city, temperature, description):
-    """Save weather query to database."""
-    conn = get_db_connection()
+    """Save weather query to database.
+
+    While the database is unhealthy, or when the insert fails, the row is
+    spooled to disk instead and written later by the replayer; Error is
+    only raised if spooling is disabled or fails as well.
+    """
+    row = (uuid.uuid4().hex, city, temperature, description, time.time())
+    if health_checker.checks["database"].status == "unhealthy" and spool_history_row(row):
+        return
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO weather_history (city, temperature, description) VALUES (%s, %s, %s)",
-            (city, temperature, description)
-        )
-        conn.commit()
+        conn = get_db_connection()
+    except Error:
+        if spool_history_row(row):
+            return
+        raise
+    try:
+        with timed_phase('db_query'):
+            write_history_rows(conn, [row])
         DATABASE_QUERIES.labels(operation='insert').inc()
-        cursor.close()
+        render_cache.clear()
     except Error as err:
         logger.error("Database error during insert: %s", err)
-        conn.rollback()
-        DATABASE_QUERIES.labels(operation='insert_error').inc()
-        raise
+        DATABASE_QUERIES.labels(operation=db_error_operation('insert', err)).inc()
+        # Spool first: on a lost connection the rollback fails as well
+        spooled = spool_history_row(row)
+        try:
+            conn.rollback()
+        except Error:
+            pass
+        if not spooled:
+            raise
     finally:
         release_db_connection(conn)
 
-def fetch_weather_from_api(city):
-    """Fetch weather data from external API."""
-    start_time = time.time()
-    params = {"key": API_KEY, "q": city}
+def replay_history_rows(records):
+    """Write spooled history records for the replayer, in one transaction."""
+    conn = get_db_connection()
     try:
-        response = requests.get(BASE_URL, params=params, timeout=10)
-        api_duration = time.time() - start_time
-        API_RESPONSE_TIME.observe(api_duration)
-        return response
-    except requests.RequestException as err:
-        logger.error("Weather API error: %s", err)
+        write_history_rows(conn, [tuple(record) for record in records])
+        DATABASE_QUERIES.labels(operation='insert_replay').inc()
+        SPOOL_ROWS.labels(result='replayed').inc(len(records))
+        render_cache.clear()
+    except (Error, ValueError, TypeError):
+        try:
+            conn.rollback()
+        except Error:
+            pass
+        DATABASE_QUERIES.labels(operation='insert_replay_error').inc()
         raise
+    finally:
+        release_db_connection(conn)
+
+def record_spool_stats(size, oldest):
+    SPOOL_BYTES.set(size)
+    SPOOL_OLDEST_AGE.set(time.time() - oldest if oldest is not None else 0)
+
+# Replays are held back while the database is known to be unhealthy
+spool_replayer = SpoolReplayer(
+    history_spool, SPOOL_REPLAY_INTERVAL, SPOOL_REPLAY_BATCH,
+    write_batch=replay_history_rows,
+    is_poison=is_poison_row_error,
+    can_write=lambda: health_checker.checks["database"].status != "unhealthy",
+    on_dead=lambda count: SPOOL_ROWS.labels(result='dead').inc(count),
+    on_stats=record_spool_stats
+)
+if history_spool is not None and os.path.isdir(SPOOL_DIR):
+    # Rows left over from before a restart still need replaying
+    spool_replayer.ensure_started()
+
+weather_cache = WeatherCache(WEATHER_CACHE_SECONDS, WEATHER_CACHE_SIZE)
+
+def get_current_weather(city):
+    """Return ``(status_code, observation, expires_at, cached)`` for a sanitized city.
+
+    Successful observations are served from weather_cache until they expire;
+    anything else goes to the upstream API. ``observation`` is None unless
+    the status code is 200, and ``cached`` is True when it came from the
+    cache. Only upstream calls are charged to the caller's rate limit, so a
+    cache miss may raise RateLimitExceeded. Raises requests.RequestException
+    like fetch_weather_from_api().
+    """
+    key = ' '.join(city.split()).lower()
+    cached = weather_cache.get(key)
+    if cached is not None:
+        observation, expires_at = cached
+        return 200, observation, expires_at, True
+
+    charge_rate_limit()
+    response = fetch_weather_from_api(city)
+    if response.status_code != 200:
+        return response.status_code, None, None, False
+    current = response.json()["current"]
+    observation = {
+        "city": city,
+        "temp_c": current["temp_c"],
+        "temperature": str(current["temp_c"]) + " \u00b0C",
+        "description": current["condition"]["text"],
+        "observed_at": current.get("last_updated_epoch") or int(time.time())
+    }
+    return 200, observation, weather_cache.set(key, observation), False
+
+def record_successful_query(city, temperature, description, store_history=True):
+    """Count a successful lookup and, unless ``store_history`` is off, store it."""
+    try:
+        if store_history:
+            save_weather_data(city, temperature, description)
+        # Custom metrics
+        put_custom_metric('SuccessfulWeatherQueries', 1, 'Count', {'status': 'success'})
+        WEATHER_QUERIES.labels(city=city_label(city), status='success').inc()
+        logger.info("Weather query successful for city: %s", city)
+    except Error:
+        # Error already logged in save_weather_data
+        pass
+
+def json_response(payload, status=200, headers=None):
+    """Serialize ``payload`` compactly, with orjson when it is installed."""
+    if orjson is not None:
+        body = orjson.dumps(payload)  # pylint: disable=no-member
+    else:
+        body = json.dumps(payload, separators=(',', ':'))
+    return app.response_class(body, status=status, headers=headers,
+                              mimetype='application/json')
+
+render_cache = RenderCache()
+
+def render_history_fragment(latest_id):
+    """Render the recent-history table, reusing it until history changes.
+
+    Returns ``(fragment, complete)``; ``complete`` is False when the table
+    only holds the "temporarily unavailable" notice, which must not be
+    cached. ``latest_id`` comes from latest_history_id(). None means the
+    database just failed or ran out of time, so the notice is rendered
+    instead of spending the rest of the request on a second query.
+    """
+    if latest_id is None:
+        return Markup(render_template("history_table.html", history=[], unavailable=True)), False
+    fragment = render_cache.get(('fragment', latest_id))
+    if fragment is not None:
+        return fragment, True
+    rows = fetch_recent_history()
+    fragment = Markup(render_template("history_table.html", history=rows or [],
+                                      unavailable=rows is None))
+    if rows is None:
+        return fragment, False
+    render_cache.set(('fragment', latest_id), fragment)
+    return fragment, True
+
+def cached_homepage():
+    """Serve the anonymous GET homepage from cache, honouring If-None-Match."""
+    latest_id = latest_history_id()
+    if latest_id is None:
+        with trace_span('render_template'), timed_phase('render'):
+            return render_template("index.html", weather=None,
+                                   history_table=render_history_fragment(None)[0],
+                                   background="default.jpg")
+
+    etag = f"home-{TEMPLATE_VERSION}-{asset_manifest.version}-{latest_id}"
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        body = render_cache.get(('page', latest_id))
+        if body is None:
+            with trace_span('render_template'), timed_phase('render'):
+                fragment, complete = render_history_fragment(latest_id)
+                body = render_template("index.html", weather=None, history_table=fragment,
+                                       background="default.jpg")
+            if not complete:
+                # The history read failed: without an ETag or a cache entry
+                # the next request renders the page afresh
+                return body
+            render_cache.set(('page', latest_id), body)
+        response = make_response(body)
+    response.set_etag(etag)
+    # Browsers and proxies may keep the page but must revalidate each time
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 def determine_background(description, temp_c):
     """Determine background image based on weather condition."""
@@ -184,33 +476,113 @@ def determine_background(description, temp_c):
         return "cold.jpg"
     return "default.jpg"
 
+@traced('sanitize')
+def sanitize_city(city):
+    """Strip everything except the characters a city name can contain."""
+    return ''.join(c for c in city if c.isalnum() or c.isspace() or c in '-.,')
+
+def make_city_hitters():
+    """Build the configured top-K tracker for the city label."""
+    if CITY_LABEL_BACKEND == "shm":
+        try:
+            return SharedHeavyHitters(CITY_LABEL_SHM_PATH, CITY_LABEL_TOP_K)
+        except OSError as err:
+            logger.error("Shared city ranking unavailable, using a per-process one: %s", err)
+    elif CITY_LABEL_BACKEND != "memory":
+        logger.error("Unknown CITY_LABEL_BACKEND %r, using a per-process ranking",
+                     CITY_LABEL_BACKEND)
+    return HeavyHitters(CITY_LABEL_TOP_K)
+
+city_hitters = make_city_hitters()
+
+def city_label(city):
+    """Return a bounded-cardinality ``city`` label value for WEATHER_QUERIES."""
+    canonical = ' '.join(city.split()).title()
+    if canonical and city_hitters.add(canonical):
+        return canonical
+    return OTHER_CITY_LABEL
+
+health_checker = HealthChecker([
+    DependencyCheck("database", probe_database, HEALTH_DB_INTERVAL, HEALTH_FAILURE_THRESHOLD),
+    DependencyCheck("api", probe_weather_api, HEALTH_API_INTERVAL, HEALTH_FAILURE_THRESHOLD)
+] + ([DependencyCheck("spool", history_spool.probe, HEALTH_SPOOL_INTERVAL,
+                      HEALTH_FAILURE_THRESHOLD)]
+     if history_spool is not None else []))
+health_checker.snapshot()
+
+admission = AdmissionController(ADMISSION_MAX_IN_FLIGHT, ADMISSION_MAX_QUEUE_SECONDS)
+
 @app.before_request
 def before_request():
     request.start_time = time.time() # pylint: disable=attribute-defined-outside-init
+    # Workers forked from a preloaded app need their own sampler thread
+    stack_sampler.ensure_started()
+    start_trace()
+    # The ALB stamps X-Amzn-Trace-Id itself but passes a client's X-Request-Start
+    # through, so the trace id wins; X-Request-Start covers nginx and HAProxy
+    request_start = (parse_amzn_trace_start(request.headers.get("X-Amzn-Trace-Id"))
+                     or parse_request_start(request.headers.get("X-Request-Start")))
+    g.deadline = min(request_start or request.start_time,
+                     request.start_time) + REQUEST_DEADLINE_SECONDS
+    if request.endpoint in ADMISSION_EXEMPT_ENDPOINTS:
+        return None
+    reason = admission.admit(request_start)
+    if reason is not None:
+        REQUESTS_SHED.labels(reason=reason).inc()
+        return json_response({"error": "Server busy, please retry"}, 503,
+                             headers={"Retry-After": str(ADMISSION_RETRY_AFTER)})
+    g.admitted = True
+    return None
+
+@app.teardown_request
+def release_admission(exc):  # pylint: disable=unused-argument
+    if g.pop("admitted", False):
+        admission.release()
 
 @app.after_request
 def after_request(response):
     if hasattr(request, 'start_time'):
         duration = time.time() - request.start_time
-        REQUEST_DURATION.observe(duration)
+        endpoint = request.endpoint or 'unknown'
+        REQUEST_DURATION.labels(
+            endpoint=endpoint,
+            method=request.method,
+            status_class=f"{response.status_code // 100}xx"
+        ).observe(duration, exemplar=trace_exemplar())
+        if REQUEST_DURATION_HIGHRES is not None:
+            REQUEST_DURATION_HIGHRES.labels(endpoint=endpoint).observe(duration)
         REQUEST_COUNT.labels(
             method=request.method,
-            endpoint=request.endpoint or 'unknown',
+            endpoint=endpoint,
             status=response.status_code
         ).inc()
 
+        timings = g.get("phase_timings", {})
+        if SERVER_TIMING_ENABLED:
+            response.headers["Server-Timing"] = server_timing_header(timings, duration)
+
         # Log slow requests
-        if duration > 2.0:
-            logger.warning("Slow request: %s %s took %.2fs",
-                           request.method, request.endpoint, duration)
+        if duration > SLOW_REQUEST_SECONDS:
+            phases_ms = {name: round(seconds * 1000, 1) for name, seconds in timings.items()}
+            logger.warning(
+                "Slow request: %s %s took %.2fs phases=%s",
+                request.method, request.endpoint, duration,
+                " ".join(f"{name}={ms}ms" for name, ms in phases_ms.items()),
+                extra={"endpoint": endpoint, "method": request.method,
+                       "status": response.status_code,
+                       "duration_ms": round(duration * 1000, 1), "phases_ms": phases_ms}
+            )
 
+    finish_trace(response)
     return response
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     weather_data = None
     background = "default.jpg"
-    history_data = []
+
+    if request.method == "GET" and not request.args:
+        return cached_homepage()
 
     if request.method == "POST":
         city = request.form.get("city", "").strip()
@@ -218,30 +590,19 @@ def index():
         # Input validation
         if not city or len(city) > 50:
             weather_data = {"error": "Invalid city name"}
-            WEATHER_QUERIES.labels(city=city, status='validation_error').inc()
+            WEATHER_QUERIES.labels(city=OTHER_CITY_LABEL, status='validation_error').inc()
         else:
             # Sanitize input
-            city = ''.join(c for c in city if c.isalnum() or c.isspace() or c in '-.,')
+            city = sanitize_city(city)
             try:
-                response = fetch_weather_from_api(city)
-
-                if response.status_code == 200:
-                    data = response.json()
-                    temp_c = data["current"]["temp_c"]
-                    temperature = str(temp_c) + " \u00b0C"
-                    description = data["current"]["condition"]["text"]
-
-                    background = determine_background(description, temp_c)
-
-                    try:
-                        save_weather_data(city, temperature, description)
-                        # Custom metrics
-                        put_custom_metric('SuccessfulWeatherQueries', 1, 'Count')
-                        WEATHER_QUERIES.labels(city=city, status='success').inc()
-                        logger.info("Weather query successful for city: %s", city)
-                    except Error:
-                        # Error already logged in save_weather_data
-                        pass
+                status_code, observation, _, _ = get_current_weather(city)
+
+                if observation is not None:
+                    temperature = observation["temperature"]
+                    description = observation["description"]
+
+                    background = determine_background(description, observation["temp_c"])
+                    record_successful_query(city, temperature, description)
 
                     weather_data = {
                         "city": city,
@@ -250,113 +611,277 @@ def index():
                     }
                 else:
                     weather_data = {"error": "City not found or API error"}
-                    put_custom_metric('FailedWeatherQueries', 1, 'Count')
-                    WEATHER_QUERIES.labels(city=city, status='api_error').inc()
+                    put_custom_metric('FailedWeatherQueries', 1, 'Count', {'status': 'api_error'})
+                    WEATHER_QUERIES.labels(city=city_label(city), status='api_error').inc()
                     logger.warning("Weather API failed for city: %s, status: %d",
-                                   city, response.status_code)
+                                   city, status_code)
 
             except requests.RequestException:
                 weather_data = {"error": "Service temporarily unavailable"}
-                put_custom_metric('APIErrorCount', 1, 'Count')
-                WEATHER_QUERIES.labels(city=city, status='request_error').inc()
+                put_custom_metric('APIErrorCount', 1, 'Count', {'status': 'request_error'})
+                WEATHER_QUERIES.labels(city=city_label(city), status='request_error').inc()
             except Exception as err: # pylint: disable=broad-except
                 logger.error("Unexpected error: %s", err)
                 weather_data = {"error": "Internal server error"}
-                put_custom_metric('UnexpectedErrorCount', 1, 'Count')
-                WEATHER_QUERIES.labels(city=city, status='unexpected_error').inc()
+                put_custom_metric('UnexpectedErrorCount', 1, 'Count',
+                                  {'status': 'unexpected_error'})
+                WEATHER_QUERIES.labels(city=city_label(city), status='unexpected_error').inc()
 
-    # Get history
-    conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT city, temperature, description, timestamp "
-            "FROM weather_history ORDER BY timestamp DESC LIMIT 10"
-        )
-        history_data = cursor.fetchall()
-        DATABASE_QUERIES.labels(operation='select').inc()
-    except Error as err:
-        logger.error("Database error fetching history: %s", err)
-        DATABASE_QUERIES.labels(operation='select_error').inc()
-    finally:
-        release_db_connection(conn)
-
-    return render_template("index.html", weather=weather_data,
-                           history=history_data, background=background)
+    with trace_span('render_template'), timed_phase('render'):
+        return render_template("index.html", weather=weather_data,
+                               history_table=render_history_fragment(latest_history_id())[0],
+                               background=background)
 
 
 @app.route("/history")
 def history():
-    conn = get_db_connection()
+    """Latest HISTORY_MAX_PAGE_SIZE rows; older ones are paged through /api/history."""
+    conn = None
     try:
+        conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute(
-            "SELECT city, temperature, description, timestamp "
-            "FROM weather_history ORDER BY timestamp DESC"
-        )
-        rows = cursor.fetchall()
+        with timed_phase('db_query'):
+            cursor.execute(bounded_select(
+                "SELECT c.name, h.temperature, h.description, h.timestamp "
+                "FROM weather_history h JOIN cities c ON c.id = h.city_id "
+                "ORDER BY h.timestamp DESC LIMIT %s"
+            ), (HISTORY_MAX_PAGE_SIZE,))
+            rows = cursor.fetchall()
         DATABASE_QUERIES.labels(operation='select_history').inc()
-        return render_template("history.html", history=rows)
+        with timed_phase('render'):
+            return render_template("history.html", history=rows,
+                                   limit=HISTORY_MAX_PAGE_SIZE)
     except Error as err:
         logger.error("Database error: %s", err)
-        DATABASE_QUERIES.labels(operation='select_history_error').inc()
-        return render_template("history.html", history=[])
+        if conn is not None:
+            DATABASE_QUERIES.labels(operation=db_error_operation('select_history', err)).inc()
+        return render_template("history.html", history=[], unavailable=True,
+                               limit=HISTORY_MAX_PAGE_SIZE)
     finally:
-        release_db_connection(conn)
+        if conn is not None:
+            release_db_connection(conn)
+
+@app.route("/api/weather")
+def api_weather():
+    """Current weather for ``city`` as JSON, sharing the observation cache."""
+    city = request.args.get("city", "").strip()
+    if not city or len(city) > 50:
+        WEATHER_QUERIES.labels(city=OTHER_CITY_LABEL, status='validation_error').inc()
+        return json_response({"error": "Invalid city name"}, 400)
+    city = sanitize_city(city)
 
-@app.route("/health")
-def health():
-    """Enhanced health check endpoint"""
-    db_status = "unhealthy"
-    db_connections = 0
     try:
-        conn = get_db_connection()
-        try:
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1")
-            db_status = "healthy"
-            db_connections = cursor.rowcount
-            cursor.close()
-        finally:
-            release_db_connection(conn)
+        status_code, observation, expires_at, cached = get_current_weather(city)
+    except requests.RequestException:
+        put_custom_metric('APIErrorCount', 1, 'Count', {'status': 'request_error'})
+        WEATHER_QUERIES.labels(city=city_label(city), status='request_error').inc()
+        return json_response({"error": "Service temporarily unavailable"}, 503)
+    if observation is None:
+        put_custom_metric('FailedWeatherQueries', 1, 'Count', {'status': 'api_error'})
+        WEATHER_QUERIES.labels(city=city_label(city), status='api_error').inc()
+        logger.warning("Weather API failed for city: %s, status: %d", city, status_code)
+        # weatherapi.com answers 400 for unknown locations
+        if status_code == 400:
+            return json_response({"error": "City not found"}, 404)
+        return json_response({"error": "Upstream weather API error"}, 502)
+
+    # City names may hold spaces or non-latin-1 characters, neither of which
+    # can go into a header as they are
+    etag = hashlib.sha1(
+        f"{' '.join(city.split()).lower()}|{observation['observed_at']}".encode()
+    ).hexdigest()[:16]
+    headers = {
+        "Cache-Control": f"public, max-age={max(0, int(expires_at - time.time()))}",
+        "Last-Modified": datetime.utcfromtimestamp(observation["observed_at"]).strftime(
+            "%a, %d %b %Y %H:%M:%S GMT")
+    }
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304, headers=headers)
+    else:
+        # Repeat polls within the cache TTL are the same observation, not
+        # new searches, so only upstream fetches go into the history
+        record_successful_query(city, observation["temperature"], observation["description"],
+                                store_history=not cached)
+        response = json_response({
+            "city": city,
+            "temperature": observation["temperature"],
+            "temp_c": observation["temp_c"],
+            "description": observation["description"],
+            "observed_at": observation["observed_at"]
+        }, headers=headers)
+    response.set_etag(etag)
+    return response
+
+@app.route("/api/history")
+@app.route("/history/search")
+def api_history():
+    """Paginated history search by city prefix as compact JSON.
+
+    Responses are revalidated against the newest history row. The search box
+    in static/js/app.js uses the /history/search URL.
+    """
+    prefix = sanitize_city(request.args.get("prefix", "").strip())[:50]
+    try:
+        cursor_ts, cursor_id = parse_history_cursor(request.args.get("cursor"))
+    except ValueError:
+        return json_response({"error": "Invalid cursor"}, 400)
+    latest_id = latest_history_id()
+    etag = None
+    if latest_id is not None:
+        etag = hashlib.sha1(
+            f"{latest_id}|{prefix}|{request.args.get('limit')}|{request.args.get('cursor')}".encode()
+        ).hexdigest()[:16]
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+
+    try:
+        page = history_page(prefix, request.args.get("limit"), cursor_ts, cursor_id)
     except Error:
-        pass
+        return json_response({"error": "History temporarily unavailable"}, 503)
+    response = json_response(page, headers={"Cache-Control": "no-cache"})
+    if etag is not None:
+        response.set_etag(etag)
+    return response
 
-    # Check external API
-    api_status = "unhealthy"
+@app.route("/admin/cities")
+@require_admin_token
+def admin_cities():
+    """Per-city query counts tracked for the weather_queries_total labels."""
+    return jsonify({
+        "top_k": city_hitters.k,
+        "capacity": city_hitters.capacity,
+        "cities": city_hitters.snapshot()
+    })
+
+PROFILE_ID_PATTERN = re.compile(r"[0-9]+-[0-9a-f]{12}")
+
+@app.route("/debug/profile", methods=["POST"])
+@require_admin_token
+def debug_profile():
+    """Start profiling this worker's stacks in the background.
+
+    ``seconds`` (default 10) and ``hz`` (default 100) control the run.
+    Answers 202 with the profile id; fetch the result from
+    /debug/profile/<id> once it has finished.
+    """
     try:
-        response = requests.get(f"{BASE_URL}?key={API_KEY}&q=London", timeout=5)
-        if response.status_code == 200:
-            api_status = "healthy"
-    except requests.RequestException:
+        seconds = float(request.args.get("seconds", "10"))
+        hz = float(request.args.get("hz", "100"))
+    except ValueError:
+        return jsonify({"error": "seconds and hz must be numbers"}), 400
+    if not 0 < seconds <= PROFILE_MAX_SECONDS or not 0 < hz <= 1000:
+        return jsonify({"error": f"seconds must be in (0, {PROFILE_MAX_SECONDS}] "
+                                 "and hz in (0, 1000]"}), 400
+    profile_id = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+    pending = os.path.join(PROFILE_DIR, f"ondemand-{profile_id}.pending")
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(pending, "w", encoding="utf-8") as handle:
+            handle.write(str(time.time() + seconds))
+    except OSError as err:
+        logger.error("Failed to start profile %s: %s", profile_id, err)
+        return jsonify({"error": "Profile directory is not writable"}), 503
+
+    def finish(counts):
+        write_profile(PROFILE_DIR, f"ondemand-{profile_id}.folded", counts, "ondemand-",
+                      PROFILE_KEEP)
+        try:
+            os.remove(pending)
+        except OSError:
+            pass
+
+    session = stack_sampler.start(seconds, hz, finish)
+    url = url_for("debug_profile_result", profile_id=profile_id)
+    return jsonify({"id": profile_id, "status": "running", "seconds": seconds,
+                    "hz": session.hz, "url": url}), 202, {
+                        "Location": url, "Retry-After": str(math.ceil(seconds))}
+
+@app.route("/debug/profile/<profile_id>")
+@require_admin_token
+def debug_profile_result(profile_id):
+    """Folded stacks of a finished profile, ready for flamegraph.pl or speedscope.
+
+    Any worker in the pod can answer, since results live in PROFILE_DIR.
+    """
+    if not PROFILE_ID_PATTERN.fullmatch(profile_id):
+        return jsonify({"error": "Unknown profile"}), 404
+    path = os.path.join(PROFILE_DIR, f"ondemand-{profile_id}")
+    try:
+        with open(path + ".folded", encoding="utf-8") as handle:
+            return handle.read(), 200, {"Content-Type": "text/plain; charset=utf-8"}
+    except FileNotFoundError:
         pass
+    try:
+        with open(path + ".pending", encoding="utf-8") as handle:
+            remaining = float(handle.read()) - time.time()
+    except (OSError, ValueError):
+        return jsonify({"error": "Unknown profile"}), 404
+    # A worker that exits mid-profile leaves its marker behind
+    if remaining < -PROFILE_MAX_SECONDS:
+        return jsonify({"error": "Profile was lost with its worker"}), 404
+    return jsonify({"id": profile_id, "status": "running"}), 202, {
+        "Retry-After": str(max(1, math.ceil(remaining)))}
+
+@app.route("/livez")
+def livez():
+    """Liveness: the worker is up and serving requests."""
+    return jsonify({"status": "alive"})
+
+@app.route("/readyz")
+def readyz():
+    """Readiness from cached checks, gated as described in readiness()."""
+    snapshot = health_checker.snapshot()
+    ready, degraded = readiness(snapshot)
+    return jsonify({
+        "status": "ready" if ready else "not_ready",
+        "degraded": degraded,
+        "checks": {name: check["status"] for name, check in snapshot.items()}
+    }), 200 if ready else 503
+
+@app.route("/health")
+def health():
+    """Enhanced health check endpoint, answered from cached check results"""
+    snapshot = health_checker.snapshot()
+    ready, degraded = readiness(snapshot)
 
-    overall_status = "healthy" if db_status == "healthy" and api_status == "healthy" else "unhealthy"
+    if not ready:
+        overall_status = "unhealthy"
+    elif degraded:
+        overall_status = "degraded"
+    else:
+        overall_status = "healthy"
 
     health_data = {
         "status": overall_status,
         "timestamp": datetime.utcnow().isoformat(),
-        "checks": {
-            "database": {
-                "status": db_status,
-                "connections": db_connections
-            },
-            "api": {
-                "status": api_status
-            }
-        }
+        "checks": snapshot
     }
 
-    status_code = 200 if overall_status == "healthy" else 503
+    status_code = 503 if overall_status == "unhealthy" else 200
     return jsonify(health_data), status_code
 
 @app.route("/metrics")
 def metrics():
     """Prometheus metrics endpoint"""
-    return generate_latest(registry), 200, {'Content-Type': CONTENT_TYPE_LATEST}
-
-# Add Prometheus WSGI middleware
-app_dispatch = DispatcherMiddleware(app, make_wsgi_app(registry))
+    body, headers = metrics_exposition.render(request.headers.get('Accept-Encoding', ''),
+                                              request.headers.get('Accept', ''))
+    return body, 200, headers
+
+# Compressed responses carry weak ETags, so the views above compare weakly
+app.wsgi_app = CompressionMiddleware(
+    app.wsgi_app,
+    min_size=COMPRESS_MIN_SIZE,
+    gzip_level=COMPRESS_GZIP_LEVEL,
+    brotli_quality=COMPRESS_BROTLI_QUALITY,
+    cache_size=COMPRESS_CACHE_SIZE,
+    on_result=lambda encoding, result: RESPONSE_COMPRESSION.labels(
+        encoding=encoding, result=result).inc()
+)
+# Fingerprinted files are answered before Flask and never change once built
+app.wsgi_app = StaticAssets(app.wsgi_app, STATIC_DIST_DIR, memory_bytes=STATIC_MEMORY_BYTES)
 
 if __name__ == "__main__":
     logger.info("Starting Weather App with Prometheus metrics")
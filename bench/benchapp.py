@@ -0,0 +1,15 @@
+"""WSGI entry point for load tests: the app, calling bench/upstream_stub.py.
+
+    gunicorn --config gunicorn.conf.py --chdir bench benchapp:app
+
+BENCH_UPSTREAM_URL overrides the stub's address.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as weather_app  # pylint: disable=wrong-import-position,import-error
+import upstream  # pylint: disable=wrong-import-position,import-error
+
+upstream.BASE_URL = os.getenv("BENCH_UPSTREAM_URL", "http://127.0.0.1:8999/v1/current.json")
+app = weather_app.app
@@ -0,0 +1,63 @@
+"""Stand-in for the CloudWatch API that accepts PutMetricData after a fixed delay.
+
+    python bench/cloudwatch_stub.py --latency 0.05 --port 5001
+    CLOUDWATCH_ENDPOINT_URL=http://127.0.0.1:5001 AWS_ACCESS_KEY_ID=stub \\
+        AWS_SECRET_ACCESS_KEY=stub gunicorn app:app
+
+Every call succeeds and the payload is discarded; the stub only counts calls
+and request bytes, which it prints on SIGINT or SIGTERM. It answers in
+whichever protocol boto3 picked (rpc-v2-cbor, JSON or query), so it works
+with old and new botocore releases. Credentials only need to be present.
+"""
+import argparse
+import signal
+import time
+
+from gevent import monkey
+monkey.patch_all()
+# pylint: disable=wrong-import-position
+import gevent
+from gevent.pywsgi import WSGIServer
+
+QUERY_RESPONSE = (b'<PutMetricDataResponse xmlns="http://monitoring.amazonaws.com/doc/2010-08-01/">'
+                  b'<ResponseMetadata><RequestId>stub</RequestId></ResponseMetadata>'
+                  b'</PutMetricDataResponse>')
+
+
+def make_app(latency, stats):
+    def application(environ, start_response):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        environ['wsgi.input'].read(length)
+        time.sleep(latency)
+        stats['calls'] += 1
+        stats['bytes'] += length
+        if environ.get('HTTP_SMITHY_PROTOCOL') == 'rpc-v2-cbor':
+            # An empty CBOR map
+            headers = [('Content-Type', 'application/cbor'), ('smithy-protocol', 'rpc-v2-cbor')]
+            body = b'\xa0'
+        elif environ.get('HTTP_X_AMZ_TARGET'):
+            headers = [('Content-Type', 'application/x-amz-json-1.0')]
+            body = b'{}'
+        else:
+            headers = [('Content-Type', 'text/xml')]
+            body = QUERY_RESPONSE
+        start_response('200 OK', headers + [('Content-Length', str(len(body)))])
+        return [body]
+    return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per call')
+    parser.add_argument('--port', type=int, default=5001)
+    args = parser.parse_args()
+    stats = {'calls': 0, 'bytes': 0}
+    server = WSGIServer(('127.0.0.1', args.port), make_app(args.latency, stats), log=None)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        gevent.signal_handler(signum, server.stop)
+    server.serve_forever()
+    print(f"{stats['calls']} PutMetricData calls, {stats['bytes']} request bytes")
+
+
+if __name__ == '__main__':
+    main()
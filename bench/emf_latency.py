@@ -0,0 +1,133 @@
+"""Time put_custom_metric() in EMF mode with a slow metrics consumer, or in API mode.
+
+``--handler stream`` rebuilds the old setup, a StreamHandler writing
+straight into a pipe. ``--handler queue`` keeps the app's own setup: a
+queue drained by a listener thread that sends UDP datagrams. In both cases
+the consumer reads only ``--drain-bytes`` per second, like a backed-up log
+shipper or CloudWatch agent. ``--handler api`` runs MetricPublisher against
+bench/cloudwatch_stub.py, flushing every ``--flush-interval`` seconds.
+
+    python bench/emf_latency.py --handler stream
+    python bench/emf_latency.py --handler queue
+    python bench/emf_latency.py --handler api
+
+Run it from the repository root. No database is needed; the app only
+logs that it cannot connect.
+"""
+import argparse
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DRAIN = r"""
+import os, sys, time
+rate, chunk = int(sys.argv[1]), 4096
+while os.read(0, chunk):
+    time.sleep(chunk / rate)
+"""
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def start_cloudwatch_stub(latency):
+    """Run bench/cloudwatch_stub.py on a free port and point the app at it."""
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    stub = subprocess.Popen(  # pylint: disable=consider-using-with
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      'cloudwatch_stub.py'),
+         '--latency', str(latency), '--port', str(port)],
+        stdout=subprocess.PIPE, text=True
+    )
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+    os.environ['CLOUDWATCH_ENDPOINT_URL'] = f"http://127.0.0.1:{port}"
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'stub')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'stub')
+    return stub
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--handler', choices=('stream', 'queue', 'api'), required=True)
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--drain-bytes', type=int, default=256 * 1024,
+                        help='bytes per second the consumer reads')
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                        help='API mode: seconds between PutMetricData flushes')
+    parser.add_argument('--api-latency', type=float, default=0.05,
+                        help='API mode: seconds the stub takes per call')
+    args = parser.parse_args()
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    stub = None
+    if args.handler == 'api':
+        stub = start_cloudwatch_stub(args.api_latency)
+        os.environ['CLOUDWATCH_METRICS_MODE'] = 'api'
+        os.environ['CLOUDWATCH_FLUSH_INTERVAL'] = str(args.flush_interval)
+    else:
+        os.environ['CLOUDWATCH_METRICS_MODE'] = 'emf'
+        os.environ['CLOUDWATCH_EMF_ENDPOINT'] = f"udp://127.0.0.1:{receiver.getsockname()[1]}"
+        os.environ.pop('CLOUDWATCH_EMF_PATH', None)
+    os.environ.setdefault('LOG_LEVEL', 'CRITICAL')
+    # pylint: disable=import-outside-toplevel,import-error
+    import app
+    import cloudwatch
+    from metrics import CLOUDWATCH_METRICS, LOGS_DROPPED
+
+    drain = None
+    if args.handler == 'stream':
+        drain = subprocess.Popen(  # pylint: disable=consider-using-with
+            [sys.executable, '-c', DRAIN, str(args.drain_bytes)],
+            stdin=subprocess.PIPE, text=True
+        )
+        handler = logging.StreamHandler(drain.stdin)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        cloudwatch.emf_logger.handlers[:] = [handler]
+
+    latencies = []
+    with app.app.test_request_context('/api/weather'):
+        for i in range(args.calls):
+            start = time.perf_counter()
+            cloudwatch.put_custom_metric('SuccessfulWeatherQueries', 1, 'Count',
+                                  {'status': 'success', 'n': i % 50})
+            latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    if stub is not None:
+        dropped = sum(sample.value for metric in CLOUDWATCH_METRICS.collect()
+                      for sample in metric.samples
+                      if sample.name.endswith('_total') and sample.labels['outcome'] == 'dropped')
+    else:
+        dropped = sum(sample.value for metric in LOGS_DROPPED.collect()
+                      for sample in metric.samples if sample.name.endswith('_total'))
+    print(f"{args.handler}: {args.calls} calls  "
+          f"p50 {percentile(latencies, 0.5) * 1e6:.0f} us  "
+          f"p99 {percentile(latencies, 0.99) * 1e6:.0f} us  "
+          f"max {latencies[-1] * 1e3:.1f} ms  "
+          f"total {sum(latencies):.2f} s  dropped {dropped:.0f}")
+    if drain is not None:
+        drain.kill()
+    if stub is not None:
+        cloudwatch.stop_publishing()
+        stub.terminate()
+        print(f"stub: {stub.communicate()[0].strip()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""Closed-loop load generator for /api/weather.
+
+    python bench/load.py --requests 400 --concurrency 200
+
+Every request asks for a different city, so each one misses the
+observation cache and waits on the upstream.
+"""
+import argparse
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5055/api/weather')
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=200)
+    args = parser.parse_args()
+
+    sequence = itertools.count()
+    latencies = []
+    outcomes = {}
+
+    def one(_):
+        city = f"City{next(sequence)}"
+        start = time.perf_counter()
+        try:
+            outcome = requests.get(args.url, params={"city": city}, timeout=60).status_code
+        except requests.RequestException as err:
+            outcome = type(err).__name__
+        latencies.append(time.perf_counter() - start)
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(one, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{args.requests / elapsed:.1f} req/s  "
+          f"p50 {latencies[len(latencies) // 2] * 1e3:.0f} ms  "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1e3:.0f} ms  {outcomes}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Measure the homepage's HTML and asset weight at a given git revision.
+
+The templates and static files are read from ``--ref`` with ``git show``,
+so the same script measures the tree before and after a change:
+
+    python bench/page_weight.py --ref 312edbf^   # CSS and JS inline in index.html
+    python bench/page_weight.py --ref 312edbf    # separate, minified bundles
+
+The page is rendered with Jinja2 alone (no database or Flask app) with
+``--rows`` history rows. HTML is gzipped at level 6 as the compression
+middleware does on the fly; bundles at level 9 as static_assets.py
+precompresses them.
+"""
+import argparse
+import gzip
+import os
+import re
+import subprocess
+import sys
+
+from jinja2 import DictLoader, Environment
+from markupsafe import Markup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from static_assets import minify  # pylint: disable=wrong-import-position,import-error
+
+
+def git_show(ref, path):
+    """Contents of ``path`` at ``ref``, or None if it does not exist there."""
+    result = subprocess.run(['git', 'show', f'{ref}:{path}'], capture_output=True, check=False)
+    return result.stdout if result.returncode == 0 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--ref', default='HEAD')
+    parser.add_argument('--rows', type=int, default=10)
+    args = parser.parse_args()
+
+    templates = {name: git_show(args.ref, f'templates/{name}').decode('utf-8')
+                 for name in ('index.html', 'history_table.html')}
+    env = Environment(loader=DictLoader(templates), autoescape=True)
+    env.globals.update(asset_url=lambda name: f'/static/dist/{name}',
+                       image_sources=lambda name: [])
+    rows = [(f'City {i}', '21.5 °C', 'Partly cloudy', '2026-10-19 06:00:00')
+            for i in range(args.rows)]
+    table = Markup(env.get_template('history_table.html').render(history=rows))
+    html = env.get_template('index.html').render(weather=None, history_table=table,
+                                                 background='default.jpg').encode('utf-8')
+    print(f"{args.ref}: HTML {len(html)} B ({len(gzip.compress(html, 6))} B gzip)")
+
+    for name in re.findall(r"asset_url\('([^']+\.(?:css|js))'\)", templates['index.html']):
+        source = git_show(args.ref, f'static/{name}')
+        if source is None:
+            continue
+        data = minify(os.path.splitext(name)[1], source)
+        print(f"  {name}: {len(data)} B ({len(gzip.compress(data, 9))} B gzip)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Stand-in for weatherapi.com that answers every request after a fixed delay.
+
+    python bench/upstream_stub.py --latency 0.5 --port 8999
+
+Needs gevent, so that hundreds of slow requests can be in flight at once.
+"""
+import argparse
+import json
+import time
+
+from gevent import monkey
+monkey.patch_all()
+# pylint: disable=wrong-import-position
+from gevent.pywsgi import WSGIServer
+
+
+def make_app(latency):
+    def application(environ, start_response):  # pylint: disable=unused-argument
+        time.sleep(latency)
+        body = json.dumps({"current": {
+            "temp_c": 12.0,
+            "condition": {"text": "Cloudy"},
+            "last_updated_epoch": int(time.time())
+        }}).encode()
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+    return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds per response')
+    parser.add_argument('--port', type=int, default=8999)
+    args = parser.parse_args()
+    WSGIServer(('127.0.0.1', args.port), make_app(args.latency), log=None).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
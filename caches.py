@@ -0,0 +1,130 @@
+"""In-process caches: the city index, upstream observations and rendered HTML."""
+import bisect
+import collections
+import threading
+import time
+
+from metrics import RENDER_CACHE, WEATHER_CACHE
+
+
+class CityIndex:
+    """In-process cache of the ``cities`` table, sorted for prefix lookups.
+
+    Keys are lower-cased so lookups match MySQL's case-insensitive collation.
+    The index is loaded lazily from the database and refreshed periodically;
+    cities resolved by this process are added once their row is committed.
+    """
+
+    def __init__(self, refresh_seconds):
+        self.refresh_seconds = refresh_seconds
+        self._keys = []
+        self._names = {}
+        self._ids = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def add(self, city, city_id):
+        key = city.lower()
+        with self._lock:
+            if key not in self._names:
+                bisect.insort(self._keys, key)
+                self._names[key] = city
+            self._ids[key] = city_id
+
+    def get_id(self, city):
+        return self._ids.get(city.lower())
+
+    def discard(self, city):
+        """Forget the cached id of ``city``; the name stays searchable."""
+        with self._lock:
+            self._ids.pop(city.lower(), None)
+
+    def load(self, rows):
+        """Replace the index contents with ``(id, name)`` rows."""
+        names = {}
+        ids = {}
+        for city_id, city in rows:
+            names[city.lower()] = city
+            ids[city.lower()] = city_id
+        with self._lock:
+            self._names = names
+            self._ids = ids
+            self._keys = sorted(names)
+            self._loaded_at = time.time()
+
+    def is_stale(self):
+        return (self._loaded_at is None
+                or time.time() - self._loaded_at > self.refresh_seconds)
+
+    def search(self, prefix, limit=10):
+        """Return up to ``limit`` known cities starting with ``prefix``."""
+        prefix = prefix.lower()
+        with self._lock:
+            start = bisect.bisect_left(self._keys, prefix)
+            matches = []
+            for key in self._keys[start:start + limit]:
+                if not key.startswith(prefix):
+                    break
+                matches.append(self._names[key])
+        return matches
+
+
+class WeatherCache:
+    """LRU cache of upstream observations that expire after ``ttl`` seconds."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return ``(observation, expires_at)`` or None when missing/expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.time():
+                self._entries.pop(key, None)
+                WEATHER_CACHE.labels(result='miss').inc()
+                return None
+            self._entries.move_to_end(key)
+            WEATHER_CACHE.labels(result='hit').inc()
+            return entry
+
+    def set(self, key, observation):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = (observation, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return expires_at
+
+
+class RenderCache:
+    """Small LRU cache of rendered HTML keyed by history version."""
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                RENDER_CACHE.labels(kind=key[0], result='hit').inc()
+            else:
+                RENDER_CACHE.labels(kind=key[0], result='miss').inc()
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,235 @@
+"""Custom CloudWatch metrics, published through PutMetricData or written as EMF.
+
+Either way request threads only hand the metric off: MetricPublisher
+aggregates events and publishes them from a daemon thread, and EMF lines go
+through a queue to a listener thread.
+"""
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import socket
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import boto3
+from flask import has_request_context, request
+
+from logging_setup import DroppingQueueHandler
+from metrics import CLOUDWATCH_METRICS, CLOUDWATCH_QUEUE_DEPTH, LOGS_DROPPED
+from tracing import timed_phase, traced
+
+logger = logging.getLogger(__name__)
+
+# CloudWatch client for custom metrics. CLOUDWATCH_ENDPOINT_URL points the
+# client at a local stub (bench/cloudwatch_stub.py, moto_server or LocalStack).
+cloudwatch = boto3.client(
+    'cloudwatch',
+    region_name=os.getenv('AWS_REGION', 'us-east-1'),
+    endpoint_url=os.getenv('CLOUDWATCH_ENDPOINT_URL') or None
+)
+CLOUDWATCH_NAMESPACE = 'WeatherApp'
+CLOUDWATCH_FLUSH_INTERVAL = float(os.getenv('CLOUDWATCH_FLUSH_INTERVAL', '60'))
+CLOUDWATCH_QUEUE_SIZE = int(os.getenv('CLOUDWATCH_QUEUE_SIZE', '10000'))
+# PutMetricData accepts at most 1000 metric data items per call
+CLOUDWATCH_MAX_BATCH = 1000
+# 'api' publishes through PutMetricData; 'emf' writes Embedded Metric Format
+# JSON lines for the CloudWatch agent and never calls AWS from the app
+CLOUDWATCH_METRICS_MODE = os.getenv('CLOUDWATCH_METRICS_MODE', 'api').lower()
+# EMF lines go to CLOUDWATCH_EMF_PATH when it is set, otherwise to the
+# CloudWatch agent's EMF listener (udp://host:port)
+CLOUDWATCH_EMF_PATH = os.getenv('CLOUDWATCH_EMF_PATH')
+CLOUDWATCH_EMF_ENDPOINT = os.getenv('CLOUDWATCH_EMF_ENDPOINT', 'udp://127.0.0.1:25888')
+CLOUDWATCH_EMF_QUEUE_SIZE = int(os.getenv('CLOUDWATCH_EMF_QUEUE_SIZE', '10000'))
+
+
+class EmfDatagramHandler(logging.Handler):
+    """Send each formatted record as one UDP datagram, e.g. to the CloudWatch agent.
+
+    Unlike logging.handlers.DatagramHandler this sends the plain message
+    rather than a pickled record. Failed sends are counted, not retried.
+    """
+
+    def __init__(self, endpoint):
+        super().__init__()
+        parts = urlsplit(endpoint)
+        if parts.scheme != 'udp' or not parts.hostname or not parts.port:
+            raise ValueError(f"CLOUDWATCH_EMF_ENDPOINT must look like udp://host:port, "
+                             f"got {endpoint!r}")
+        self.address = (parts.hostname, parts.port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, record):
+        try:
+            self.sock.sendto(self.format(record).encode('utf-8'), self.address)
+        except OSError:
+            LOGS_DROPPED.labels(reason='emf_send_failed').inc()
+
+    def close(self):
+        self.sock.close()
+        super().close()
+
+
+class MetricPublisher:
+    """Aggregate custom metrics in the background and publish them in batches.
+
+    Request threads only enqueue events. A daemon thread drains the queue
+    every ``interval`` seconds, folds the events into one StatisticSet per
+    metric and sends them with as few PutMetricData calls as possible.
+    The queue is bounded; when it is full new events are dropped and counted.
+    """
+
+    def __init__(self, client, namespace, interval, max_queue):
+        self.client = client
+        self.namespace = namespace
+        self.interval = interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        # Gunicorn forks workers after import, so each process starts its own thread
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name='cloudwatch-publisher', daemon=True
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def put(self, metric_name, value, unit='Count'):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((metric_name, unit, value))
+            CLOUDWATCH_METRICS.labels(outcome='queued').inc()
+        except queue.Full:
+            CLOUDWATCH_METRICS.labels(outcome='dropped').inc()
+        CLOUDWATCH_QUEUE_DEPTH.set(self._queue.qsize())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def _drain(self):
+        stats = {}
+        while True:
+            try:
+                metric_name, unit, value = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            stat = stats.get((metric_name, unit))
+            if stat is None:
+                stats[(metric_name, unit)] = {
+                    'SampleCount': 1, 'Sum': value, 'Minimum': value, 'Maximum': value
+                }
+            else:
+                stat['SampleCount'] += 1
+                stat['Sum'] += value
+                stat['Minimum'] = min(stat['Minimum'], value)
+                stat['Maximum'] = max(stat['Maximum'], value)
+        CLOUDWATCH_QUEUE_DEPTH.set(self._queue.qsize())
+        return stats
+
+    def flush(self):
+        """Publish everything queued so far."""
+        stats = self._drain()
+        if not stats:
+            return
+        timestamp = datetime.utcnow()
+        metric_data = [
+            {
+                'MetricName': metric_name,
+                'StatisticValues': stat,
+                'Unit': unit,
+                'Timestamp': timestamp
+            }
+            for (metric_name, unit), stat in stats.items()
+        ]
+        for start in range(0, len(metric_data), CLOUDWATCH_MAX_BATCH):
+            batch = metric_data[start:start + CLOUDWATCH_MAX_BATCH]
+            events = sum(item['StatisticValues']['SampleCount'] for item in batch)
+            try:
+                self.client.put_metric_data(Namespace=self.namespace, MetricData=batch)
+                CLOUDWATCH_METRICS.labels(outcome='published').inc(events)
+            except Exception as err:
+                logger.error("Failed to publish %d custom metrics: %s", len(batch), err)
+                CLOUDWATCH_METRICS.labels(outcome='failed').inc(events)
+
+    def stop(self):
+        """Stop the background thread after a final flush."""
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 5)
+
+
+metric_publisher = MetricPublisher(
+    cloudwatch, CLOUDWATCH_NAMESPACE, CLOUDWATCH_FLUSH_INTERVAL, CLOUDWATCH_QUEUE_SIZE
+)
+
+# Dedicated EMF stream so metric lines never mix with application logs. Like
+# the application logs it is written by a listener thread, so a slow disk or
+# agent never holds up a request; lines are dropped once the queue is full.
+emf_logger = logging.getLogger('weather_app.emf')
+emf_logger.propagate = False
+emf_listener = None
+if CLOUDWATCH_METRICS_MODE == 'emf':
+    emf_handler = (logging.FileHandler(CLOUDWATCH_EMF_PATH) if CLOUDWATCH_EMF_PATH
+                   else EmfDatagramHandler(CLOUDWATCH_EMF_ENDPOINT))
+    emf_handler.setFormatter(logging.Formatter('%(message)s'))
+    emf_queue = queue.Queue(maxsize=CLOUDWATCH_EMF_QUEUE_SIZE)
+    emf_logger.addHandler(DroppingQueueHandler(emf_queue, drop_reason='emf_queue_full'))
+    emf_logger.setLevel(logging.INFO)
+    emf_listener = logging.handlers.QueueListener(emf_queue, emf_handler)
+    emf_listener.start()
+
+
+def stop_publishing():
+    """Publish what is still queued; register at exit after the app's log listener."""
+    metric_publisher.stop()
+    if emf_listener is not None:
+        emf_listener.stop()
+
+
+def emit_emf_metric(metric_name, value, unit='Count', dimensions=None):
+    """Write one metric as a CloudWatch Embedded Metric Format log line."""
+    dims = {key: str(val) for key, val in (dimensions or {}).items()}
+    if has_request_context():
+        dims.setdefault('endpoint', request.endpoint or 'unknown')
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': CLOUDWATCH_NAMESPACE,
+                'Dimensions': [sorted(dims)],
+                'Metrics': [{'Name': metric_name, 'Unit': unit}]
+            }]
+        },
+        metric_name: value
+    }
+    record.update(dims)
+    emf_logger.info(json.dumps(record, separators=(',', ':')))
+
+
+@traced('put_custom_metric')
+def put_custom_metric(metric_name, value, unit='Count', dimensions=None):
+    """Record a custom CloudWatch metric using the configured output mode.
+
+    Dimensions are only attached in EMF mode, where they cost nothing extra;
+    API mode keeps publishing the existing undimensioned metrics.
+    """
+    with timed_phase('cloudwatch'):
+        if CLOUDWATCH_METRICS_MODE == 'emf':
+            emit_emf_metric(metric_name, value, unit, dimensions)
+        else:
+            metric_publisher.put(metric_name, value, unit)
@@ -0,0 +1,239 @@
+"""WSGI middleware that compresses HTML, JSON and other text responses.
+
+The encoding is negotiated from Accept-Encoding: brotli when the optional
+``brotli`` package is installed and the client prefers it, gzip otherwise.
+Bodies with a known length under ``min_size`` are passed through untouched
+since the framing overhead outweighs the saving. Responses without a
+Content-Length are compressed chunk by chunk so streaming is preserved.
+
+Responses that carry an ETag are versioned by the app, so their compressed
+form is kept in a small LRU and reused until the ETag changes.
+"""
+import collections
+import threading
+import zlib
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional brotli support
+    brotli = None
+
+COMPRESSIBLE_TYPES = (
+    'text/', 'application/json', 'application/javascript', 'application/xml',
+    'image/svg+xml'
+)
+
+
+def choose_encoding(accept_encoding, supported=None):
+    """Pick one of ``supported`` (br, then gzip) from Accept-Encoding, or None."""
+    if supported is None:
+        supported = ('br', 'gzip') if brotli is not None else ('gzip',)
+    weights = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding == '*':
+            for name in supported:
+                weights.setdefault(name, quality)
+        elif coding in supported:
+            weights[coding] = quality
+    best = None
+    for name in supported:
+        if weights.get(name, 0) > 0 and (best is None or weights[name] > weights[best]):
+            best = name
+    return best
+
+
+class _Compressor:
+    """Incremental compressor with one interface for gzip and brotli."""
+
+    def __init__(self, encoding, level):
+        self.encoding = encoding
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=level)
+        else:
+            self._brotli = None
+            self._zlib = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        """Compress ``data`` and flush so the client can decode it right away."""
+        if self._brotli is not None:
+            return self._brotli.process(data) + self._brotli.flush()
+        return self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data=b''):
+        if self._brotli is not None:
+            return self._brotli.process(data) + self._brotli.finish()
+        return self._zlib.compress(data) + self._zlib.flush()
+
+
+class CompressionMiddleware:
+    """Compress eligible responses of ``wsgi_app``.
+
+    ``gzip_level`` and ``brotli_quality`` default to settings that suit
+    dynamic pages; ``on_result`` is called with (encoding, result) so the
+    app can count compressed, cached and skipped responses.
+    """
+
+    def __init__(self, wsgi_app, min_size=1024, gzip_level=6, brotli_quality=5,
+                 cache_size=64, on_result=None):
+        self.wsgi_app = wsgi_app
+        self.min_size = min_size
+        self.levels = {'gzip': gzip_level, 'br': brotli_quality}
+        self.cache_size = cache_size
+        self.on_result = on_result
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.wsgi_app(environ, start_response)
+
+        captured = {}
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            return written.append
+
+        app_iter = self.wsgi_app(environ, capture)
+        status, headers = captured['status'], captured['headers']
+        if not self._compressible(status, headers):
+            start_response(status, headers, captured['exc_info'])
+            return self._prepend(written, app_iter)
+
+        length = self._header(headers, 'Content-Length')
+        if length is None:
+            self._report(encoding, 'streamed')
+            start_response(status, self._rewrite(headers, encoding, None),
+                           captured['exc_info'])
+            return self._stream(written, app_iter, _Compressor(encoding, self.levels[encoding]))
+
+        try:
+            body = b''.join(written) + b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        if len(body) < self.min_size:
+            self._report(encoding, 'skipped_small')
+            start_response(status, headers, captured['exc_info'])
+            return [body]
+
+        etag = self._header(headers, 'ETag')
+        key = None
+        if etag is not None:
+            # ETags are only unique per resource
+            key = (environ.get('PATH_INFO'), environ.get('QUERY_STRING'), etag, encoding)
+        compressed = self._cached(key)
+        if compressed is None:
+            compressed = _Compressor(encoding, self.levels[encoding]).finish(body)
+            self._store(key, compressed)
+            self._report(encoding, 'compressed')
+        else:
+            self._report(encoding, 'cached')
+        start_response(status, self._rewrite(headers, encoding, len(compressed)),
+                       captured['exc_info'])
+        return [compressed]
+
+    @staticmethod
+    def _header(headers, name):
+        name = name.lower()
+        for key, value in headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    def _compressible(self, status, headers):
+        if not status.startswith('200'):
+            return False
+        if self._header(headers, 'Content-Encoding') is not None:
+            return False
+        if 'no-transform' in (self._header(headers, 'Cache-Control') or ''):
+            return False
+        content_type = (self._header(headers, 'Content-Type') or '').lower()
+        return content_type.startswith(COMPRESSIBLE_TYPES)
+
+    def _rewrite(self, headers, encoding, length):
+        """Headers for the encoded body: new length, weak ETag, Vary."""
+        rewritten = []
+        vary = None
+        for key, value in headers:
+            lowered = key.lower()
+            if lowered == 'content-length':
+                continue
+            if lowered == 'vary':
+                vary = value
+                continue
+            if lowered == 'etag' and not value.startswith('W/'):
+                # The encoded bytes differ from the identity representation
+                value = 'W/' + value
+            rewritten.append((key, value))
+        rewritten.append(('Content-Encoding', encoding))
+        if vary is None:
+            vary = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            vary = f'{vary}, Accept-Encoding'
+        rewritten.append(('Vary', vary))
+        if length is not None:
+            rewritten.append(('Content-Length', str(length)))
+        return rewritten
+
+    def _cached(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            body = self._cache.get(key)
+            if body is not None:
+                self._cache.move_to_end(key)
+            return body
+
+    def _store(self, key, body):
+        if key is None or self.cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = body
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _report(self, encoding, result):
+        if self.on_result is not None:
+            self.on_result(encoding, result)
+
+    @staticmethod
+    def _prepend(written, app_iter):
+        if not written:
+            return app_iter
+
+        def chained():
+            try:
+                yield from written
+                yield from app_iter
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        return chained()
+
+    @staticmethod
+    def _stream(written, app_iter, compressor):
+        try:
+            for chunk in written:
+                if chunk:
+                    yield compressor.compress(chunk)
+            for chunk in app_iter:
+                if chunk:
+                    yield compressor.compress(chunk)
+            yield compressor.finish()
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
@@ -0,0 +1,150 @@
+"""MySQL connections for the weather app.
+
+Connections come from a mysql-connector pool, and reads are bounded by what
+is left of the current request's deadline.
+"""
+import logging
+import os
+import sys
+import threading
+
+import mysql.connector
+from mysql.connector import Error, errorcode
+from mysql.connector.errors import PoolError
+
+from admission import time_left
+from metrics import ACTIVE_CONNECTIONS, DATABASE_QUERIES
+from migrate import create_tables, pending_migrations
+from tracing import timed_phase
+
+logger = logging.getLogger(__name__)
+
+# DB reads get what is left of the request's time budget, capped per
+# statement, through MAX_EXECUTION_TIME hints; socket timeouts bound
+# everything else.
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_READ_TIMEOUT = int(os.getenv("DB_READ_TIMEOUT", "15"))
+DB_WRITE_TIMEOUT = int(os.getenv("DB_WRITE_TIMEOUT", "15"))
+
+
+def cooperative_io():
+    """True when gevent has patched sockets (gunicorn's gevent worker)."""
+    gevent_monkey = sys.modules.get("gevent.monkey")
+    return gevent_monkey is not None and gevent_monkey.is_module_patched("socket")
+
+
+# Under gevent workers one process serves many requests at once, so they
+# wait up to DB_POOL_WAIT_SECONDS for a pooled connection instead of failing
+# as soon as the pool is exhausted
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_POOL_WAIT_SECONDS = float(os.getenv("DB_POOL_WAIT_SECONDS", "5"))
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+
+# MySQL connection with connection pooling
+db_config = {
+    'host': os.getenv("DB_HOST"),
+    'user': os.getenv("DB_USER"),
+    'password': os.getenv("DB_PASSWORD"),
+    'database': os.getenv("DB_NAME"),
+    'pool_name': 'weather_app_pool',
+    'pool_size': DB_POOL_SIZE,
+    'pool_reset_session': True,
+    'connection_timeout': DB_CONNECT_TIMEOUT,
+    'read_timeout': DB_READ_TIMEOUT,
+    'write_timeout': DB_WRITE_TIMEOUT
+}
+if cooperative_io():
+    # The C extension does its socket I/O outside Python and would block
+    # every request in the worker, not just the one waiting on MySQL
+    db_config['use_pure'] = True
+
+# Server-side statement timeout, the client read timeout (lost connection)
+# and a budget that ran out before the query was sent
+DB_TIMEOUT_ERRNOS = {errorcode.ER_QUERY_TIMEOUT, errorcode.CR_SERVER_LOST}
+
+
+def bounded_select(sql):
+    """Add a MAX_EXECUTION_TIME hint sized to the request's remaining budget.
+
+    Raises a timeout Error without touching the database when the budget is
+    already spent, so callers take the same path as for a server timeout.
+    """
+    timeout_ms = int(time_left(DB_STATEMENT_TIMEOUT_MS / 1000.0) * 1000)
+    if timeout_ms <= 0:
+        raise Error(msg="Request deadline exceeded", errno=errorcode.ER_QUERY_TIMEOUT)
+    return sql.replace("SELECT ", f"SELECT /*+ MAX_EXECUTION_TIME({timeout_ms}) */ ", 1)
+
+
+def db_error_operation(operation, err):
+    """DATABASE_QUERIES label for a failed ``operation``: _timeout or _error."""
+    return f"{operation}_timeout" if err.errno in DB_TIMEOUT_ERRNOS else f"{operation}_error"
+
+
+def get_db_connection():
+    if not db_pool_slots.acquire(timeout=DB_POOL_WAIT_SECONDS):
+        DATABASE_QUERIES.labels(operation='connect_error').inc()
+        logger.error("Timed out waiting for a pooled database connection")
+        raise PoolError("Timed out waiting for a pooled database connection")
+    try:
+        with timed_phase('db_connect'):
+            conn = mysql.connector.connect(**db_config)
+        ACTIVE_CONNECTIONS.inc()
+        DATABASE_QUERIES.labels(operation='connect').inc()
+        return conn
+    except Error as err:
+        db_pool_slots.release()
+        logger.error("Database connection error: %s", err)
+        DATABASE_QUERIES.labels(operation='connect_error').inc()
+        raise
+
+
+def release_db_connection(conn):
+    # Close even a dead connection: a pooled one goes back to the pool either
+    # way, and skipping close() would leak its pool slot for good
+    try:
+        conn.close()
+        DATABASE_QUERIES.labels(operation='disconnect').inc()
+    except Error as err:
+        logger.error("Error closing database connection: %s", err)
+        DATABASE_QUERIES.labels(operation='disconnect_error').inc()
+    finally:
+        ACTIVE_CONNECTIONS.dec()
+        db_pool_slots.release()
+
+
+def init_db():
+    """Initialize database schema.
+
+    Only missing tables are created here, since every worker runs this at
+    import. Upgrading an existing schema is left to ``python migrate.py``.
+    """
+    conn = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        create_tables(cursor)
+        conn.commit()
+        pending = pending_migrations(cursor)
+        cursor.close()
+        if pending:
+            logger.error("Database schema needs migrating (%s); run `python migrate.py`",
+                         ", ".join(pending))
+        else:
+            logger.info("Database schema initialized.")
+    except Error as err:
+        logger.error("Failed to initialize database: %s", err)
+    finally:
+        if conn:
+            release_db_connection(conn)
+
+
+def probe_database():
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+    finally:
+        release_db_connection(conn)
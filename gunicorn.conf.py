@@ -0,0 +1,52 @@
+"""Gunicorn settings for the Weather App.
+
+Prometheus metrics are shared between workers through mmap-backed files in
+PROMETHEUS_MULTIPROC_DIR. The directory has to be set before any worker
+imports prometheus_client, be emptied when the server starts, and have a
+worker's live gauges removed when that worker exits. The master serves the
+aggregated metrics on METRICS_PORT so scrapes never take a worker slot.
+
+GUNICORN_WORKER_CLASS=gevent switches to cooperative workers: gunicorn
+monkey-patches each worker before importing the app, so a request waiting
+on the weather API, MySQL or CloudWatch yields to the others and one worker
+can hold up to GUNICORN_WORKER_CONNECTIONS requests in flight.
+"""
+import os
+import shutil
+
+# Must run before anything imports prometheus_client, which picks its
+# value classes from this variable at import time
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+
+# pylint: disable=wrong-import-position
+from prometheus_client import CollectorRegistry, multiprocess
+
+from metrics_exposition import CachedExposition, start_metrics_server
+# pylint: enable=wrong-import-position
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_CACHE_SECONDS = float(os.getenv("METRICS_CACHE_SECONDS", "5"))
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Start every server with an empty metrics directory."""
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def when_ready(server):  # pylint: disable=unused-argument
+    """Start the aggregated metrics endpoint in the master process."""
+    if not METRICS_PORT:
+        return
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_metrics_server(METRICS_PORT, CachedExposition(registry, METRICS_CACHE_SECONDS))
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drop the exited worker's live gauge files."""
+    multiprocess.mark_process_dead(worker.pid)
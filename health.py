@@ -0,0 +1,101 @@
+"""Dependency health checks run in the background for /health, /readyz and /livez."""
+import os
+import threading
+import time
+
+
+class DependencyCheck:
+    """Result of periodically probing one dependency.
+
+    The reported status only turns unhealthy after ``failure_threshold``
+    consecutive failures and recovers on the first success, so a single slow
+    probe does not flip readiness.
+    """
+
+    def __init__(self, name, probe, interval, failure_threshold):
+        self.name = name
+        self.probe = probe
+        self.interval = interval
+        self.failure_threshold = failure_threshold
+        self.status = "unknown"
+        self.consecutive_failures = 0
+        self.last_checked = None
+        self.last_error = None
+        self.latency_ms = None
+
+    def due(self, now):
+        return self.last_checked is None or now - self.last_checked >= self.interval
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self.probe()
+        except Exception as err:
+            self.consecutive_failures += 1
+            self.last_error = str(err)
+            if self.status == "unknown" or self.consecutive_failures >= self.failure_threshold:
+                self.status = "unhealthy"
+        else:
+            self.consecutive_failures = 0
+            self.last_error = None
+            self.status = "healthy"
+        self.latency_ms = round((time.perf_counter() - start) * 1000, 1)
+        self.last_checked = time.monotonic()
+
+    def snapshot(self):
+        return {
+            "status": self.status,
+            "consecutive_failures": self.consecutive_failures,
+            "latency_ms": self.latency_ms,
+            "last_error": self.last_error,
+            "age_seconds": (round(time.monotonic() - self.last_checked, 1)
+                            if self.last_checked is not None else None)
+        }
+
+
+class HealthChecker:
+    """Run dependency checks on their own schedule in a daemon thread."""
+
+    def __init__(self, checks):
+        self.checks = {check.name: check for check in checks}
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(
+                    target=self._run, name='health-checker', daemon=True
+                )
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            for check in self.checks.values():
+                if check.due(now):
+                    check.run()
+            time.sleep(1)
+
+    def snapshot(self):
+        self._ensure_started()
+        return {name: check.snapshot() for name, check in self.checks.items()}
+
+
+def readiness(snapshot):
+    """Return ``(ready, degraded)`` for a health snapshot.
+
+    With the spool enabled, history writes survive a database outage, so
+    the pod stays in rotation as long as the spool can take rows and a
+    down database only degrades it. Without the spool the database gates
+    traffic. The upstream API only ever degrades: every pod shares it.
+    """
+    gate = "spool" if "spool" in snapshot else "database"
+    ready = snapshot[gate]["status"] == "healthy"
+    degraded = any(check["status"] == "unhealthy"
+                   for name, check in snapshot.items() if name != gate)
+    return ready, degraded
@@ -0,0 +1,122 @@
+"""Space-saving top-K trackers for bounding metric label cardinality.
+
+Both trackers expose ``add(key)`` returning whether ``key`` is currently in
+the top K, and ``snapshot()`` listing the tracked keys:
+
+* ``SharedHeavyHitters`` keeps its counters in an mmap'd file, so every
+  gunicorn worker on a node agrees on which keys get their own label.
+* ``HeavyHitters`` is per-process. Each worker then ranks only the traffic
+  it happened to serve, so workers can disagree near the cut-off.
+"""
+import fcntl
+import heapq
+import mmap
+import os
+import struct
+import threading
+
+
+class HeavyHitters:
+    """Space-saving top-K tracker over a stream of keys.
+
+    Keeps at most ``capacity`` counters. When a new key arrives and the table
+    is full, the smallest counter is reassigned to it and its old count is
+    kept as the new key's overestimation error. Any key whose true frequency
+    exceeds N / capacity is guaranteed to be tracked.
+    """
+
+    def __init__(self, k, capacity=None):
+        self.k = k
+        self.capacity = capacity or 4 * k
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, key):
+        """Count ``key`` and return True if it is currently in the top K."""
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None:
+                entry[0] += 1
+            elif len(self._counts) < self.capacity:
+                self._counts[key] = [1, 0]
+            else:
+                victim = min(self._counts, key=lambda item: self._counts[item][0])
+                floor = self._counts.pop(victim)[0]
+                self._counts[key] = [floor + 1, floor]
+            # Rank by guaranteed count so a freshly evicted-into key, which
+            # inherits the victim's count as error, cannot claim a label
+            top = heapq.nlargest(self.k, self._counts.items(),
+                                 key=lambda item: item[1][0] - item[1][1])
+            return any(item[0] == key for item in top)
+
+    def snapshot(self):
+        """Return tracked keys with estimated counts, most frequent first."""
+        with self._lock:
+            items = sorted(self._counts.items(), key=lambda item: item[1][0], reverse=True)
+        return [{"key": key, "count": count, "error": error} for key, (count, error) in items]
+
+
+class SharedHeavyHitters:
+    """The space-saving table of HeavyHitters in a file shared by every process.
+
+    The file holds ``capacity`` fixed-size records (UTF-8 key, count, error);
+    a zero count marks a free record. Eviction has to see every counter, so
+    each update locks the whole file, which stays small: 4 * k records of
+    ``RECORD.size`` bytes. Keys longer than ``MAX_KEY_BYTES`` are truncated.
+    """
+
+    MAX_KEY_BYTES = 200
+    RECORD = struct.Struct(f'<{MAX_KEY_BYTES}sQQ')
+
+    def __init__(self, path, k, capacity=None):
+        self.k = k
+        self.capacity = capacity or 4 * k
+        size = self.RECORD.size * self.capacity
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        # fcntl locks are per process, so threads in one worker also need this
+        self._lock = threading.Lock()
+
+    def _encode(self, key):
+        # Cut on a character boundary so the stored key still decodes
+        return key.encode('utf-8')[:self.MAX_KEY_BYTES].decode('utf-8', 'ignore').encode('utf-8')
+
+    def add(self, key):
+        """Count ``key`` and return True if it is currently in the top K."""
+        encoded = self._encode(key)
+        stored = encoded.ljust(self.MAX_KEY_BYTES, b'\0')
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                records = list(self.RECORD.iter_unpack(self._map))
+                slot = next((index for index, (name, count, _) in enumerate(records)
+                             if count and name == stored), None)
+                if slot is not None:
+                    _, count, error = records[slot]
+                    records[slot] = (stored, count + 1, error)
+                else:
+                    # A free record has count 0, so it is always the minimum
+                    slot = min(range(len(records)), key=lambda index: records[index][1])
+                    floor = records[slot][1]
+                    records[slot] = (stored, floor + 1, floor)
+                self.RECORD.pack_into(self._map, slot * self.RECORD.size, *records[slot])
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        # Same ranking by guaranteed count as HeavyHitters.add()
+        top = heapq.nlargest(self.k, (record for record in records if record[1]),
+                             key=lambda record: record[1] - record[2])
+        return any(record[0] == stored for record in top)
+
+    def snapshot(self):
+        """Return tracked keys with estimated counts, most frequent first."""
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_SH)
+            try:
+                records = [record for record in self.RECORD.iter_unpack(self._map) if record[1]]
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+        records.sort(key=lambda record: record[1], reverse=True)
+        return [{"key": name.rstrip(b'\0').decode('utf-8'), "count": count, "error": error}
+                for name, count, error in records]
@@ -0,0 +1,275 @@
+"""Weather history storage: writing rows, recent history and city prefix search."""
+import logging
+import os
+from datetime import datetime
+
+from mysql.connector import Error, errorcode
+
+from caches import CityIndex
+from db import bounded_select, db_error_operation, get_db_connection, release_db_connection
+from metrics import DATABASE_QUERIES
+from tracing import timed_phase, traced
+
+logger = logging.getLogger(__name__)
+
+# History search pagination and in-memory city index refresh
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "20"))
+HISTORY_MAX_PAGE_SIZE = 100
+CITY_INDEX_REFRESH_SECONDS = int(os.getenv("CITY_INDEX_REFRESH_SECONDS", "300"))
+
+city_index = CityIndex(CITY_INDEX_REFRESH_SECONDS)
+
+
+def resolve_city_id(cursor, city, resolved):
+    """Return the ``cities`` id for ``city``, creating the row if needed.
+
+    Ids looked up in the database are collected in ``resolved`` instead of
+    going straight into city_index: a new cities row disappears again if
+    the transaction rolls back.
+    """
+    city_id = city_index.get_id(city)
+    if city_id is None:
+        city_id = resolved.get(city)
+    if city_id is not None:
+        return city_id
+    # LAST_INSERT_ID(id) makes lastrowid report the existing id on duplicates
+    cursor.execute(
+        "INSERT INTO cities (name) VALUES (%s) "
+        "ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)",
+        (city,)
+    )
+    city_id = cursor.lastrowid
+    DATABASE_QUERIES.labels(operation='insert_city').inc()
+    resolved[city] = city_id
+    return city_id
+
+
+def insert_history_rows(cursor, rows):
+    """Insert ``(row_key, city, temperature, description, observed_at)`` rows.
+
+    A row whose key is already stored is left alone, so replaying a batch
+    that was partly written before never duplicates history. Returns the
+    city ids resolved through the database, as ``{city: id}``.
+    """
+    resolved = {}
+    values = [(row_key, resolve_city_id(cursor, city, resolved), temperature, description,
+               observed_at)
+              for row_key, city, temperature, description, observed_at in rows]
+    cursor.executemany(
+        "INSERT INTO weather_history (row_key, city_id, temperature, description, timestamp) "
+        "VALUES (%s, %s, %s, %s, FROM_UNIXTIME(%s)) "
+        "ON DUPLICATE KEY UPDATE id = id",
+        values
+    )
+    return resolved
+
+
+def write_history_rows(conn, rows):
+    """Insert ``rows`` on ``conn`` and commit; the caller rolls back on Error.
+
+    City ids only reach city_index after the commit. On failure the cities
+    involved are evicted from it as well, in case a cached id was the
+    reason the database refused the rows.
+    """
+    cursor = conn.cursor()
+    try:
+        resolved = insert_history_rows(cursor, rows)
+        conn.commit()
+    except Error:
+        for row in rows:
+            city_index.discard(row[1])
+        raise
+    finally:
+        cursor.close()
+    for city, city_id in resolved.items():
+        city_index.add(city, city_id)
+
+
+# Errors caused by the contents of a single row, which no retry can fix
+POISON_ROW_ERRNOS = {
+    errorcode.ER_NO_REFERENCED_ROW_2, errorcode.ER_BAD_NULL_ERROR, errorcode.ER_DATA_TOO_LONG,
+    errorcode.ER_TRUNCATED_WRONG_VALUE, errorcode.ER_TRUNCATED_WRONG_VALUE_FOR_FIELD,
+    errorcode.ER_WARN_DATA_OUT_OF_RANGE
+}
+
+
+def is_poison_row_error(err):
+    """True when ``err`` is down to a spooled row rather than the database.
+
+    Connection errors, timeouts and anything else that would fail every row
+    alike (a missing column, a read-only replica) are not.
+    """
+    if isinstance(err, Error):
+        return err.errno in POISON_ROW_ERRNOS
+    # A malformed record that does not unpack into a history row
+    return isinstance(err, (ValueError, TypeError))
+
+
+@traced('fetch_recent_history')
+def fetch_recent_history():
+    """Return the latest 10 history rows, or None on DB errors and timeouts."""
+    try:
+        conn = get_db_connection()
+    except Error:
+        return None
+    try:
+        cursor = conn.cursor()
+        with timed_phase('db_query'):
+            cursor.execute(bounded_select(
+                "SELECT c.name, h.temperature, h.description, h.timestamp "
+                "FROM weather_history h JOIN cities c ON c.id = h.city_id "
+                "ORDER BY h.timestamp DESC LIMIT 10"
+            ))
+            rows = cursor.fetchall()
+        DATABASE_QUERIES.labels(operation='select').inc()
+        return rows
+    except Error as err:
+        logger.error("Database error fetching history: %s", err)
+        DATABASE_QUERIES.labels(operation=db_error_operation('select', err)).inc()
+        return None
+    finally:
+        release_db_connection(conn)
+
+
+@traced('latest_history_id')
+def latest_history_id():
+    """Return the newest history id (0 when empty), or None on query errors.
+
+    MAX(id) is read from the end of the primary key, so this is far cheaper
+    than the recent-history join and is enough to tell whether anything
+    rendered from the history is still current.
+    """
+    try:
+        conn = get_db_connection()
+    except Error:
+        return None
+    try:
+        cursor = conn.cursor()
+        with timed_phase('db_query'):
+            cursor.execute(bounded_select("SELECT MAX(id) FROM weather_history"))
+            latest_id = cursor.fetchone()[0] or 0
+        cursor.close()
+        DATABASE_QUERIES.labels(operation='select_latest_id').inc()
+        return latest_id
+    except Error as err:
+        logger.error("Database error fetching latest history id: %s", err)
+        DATABASE_QUERIES.labels(operation=db_error_operation('select_latest_id', err)).inc()
+        return None
+    finally:
+        release_db_connection(conn)
+
+
+def refresh_city_index():
+    """Reload the distinct city list if it is stale."""
+    if not city_index.is_stale():
+        return
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        with timed_phase('db_query'):
+            cursor.execute(bounded_select("SELECT id, name FROM cities"))
+            rows = cursor.fetchall()
+        city_index.load(rows)
+        cursor.close()
+        DATABASE_QUERIES.labels(operation='select_cities').inc()
+    except Error as err:
+        logger.error("Database error loading city index: %s", err)
+        DATABASE_QUERIES.labels(operation=db_error_operation('select_cities', err)).inc()
+    finally:
+        release_db_connection(conn)
+
+
+def search_history(prefix, limit, cursor_ts=None, cursor_id=None):
+    """Fetch one page of history rows whose city starts with ``prefix``.
+
+    An empty prefix pages through all history.
+
+    Without a prefix, rows are read newest first straight from
+    idx_timestamp, and keyset pagination on (timestamp, id) keeps deep pages
+    as cheap as the first one. A prefix is a range on the unique index on
+    ``cities.name``, and each matching city's rows are found through
+    idx_city_timestamp. Those rows are not in timestamp order across cities,
+    so MySQL still filesorts them, keeping only the top LIMIT rows. The cost
+    therefore grows with the history of the matching cities, not the table.
+    """
+    query = ("SELECT h.id, c.name, h.temperature, h.description, h.timestamp "
+             "FROM weather_history h JOIN cities c ON c.id = h.city_id")
+    conditions = []
+    params = []
+    if prefix:
+        # sanitize_city() has already removed LIKE wildcards from the prefix
+        conditions.append("c.name LIKE %s")
+        params.append(prefix + '%')
+    if cursor_ts is not None:
+        # Same rows as (timestamp, id) < cursor, written so the leading
+        # range condition can seek into the timestamp index
+        conditions.append("h.timestamp <= %s AND (h.timestamp < %s OR h.id < %s)")
+        params.extend([cursor_ts, cursor_ts, cursor_id])
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY h.timestamp DESC, h.id DESC LIMIT %s"
+    params.append(limit)
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        with timed_phase('db_query'):
+            cursor.execute(bounded_select(query), params)
+            rows = cursor.fetchall()
+        cursor.close()
+        DATABASE_QUERIES.labels(operation='select_search').inc()
+        return rows
+    except Error as err:
+        logger.error("Database error searching history: %s", err)
+        DATABASE_QUERIES.labels(operation=db_error_operation('select_search', err)).inc()
+        raise
+    finally:
+        release_db_connection(conn)
+
+
+def parse_history_cursor(page_cursor):
+    """Split a ``<timestamp>_<id>`` page cursor; raises ValueError if malformed."""
+    if not page_cursor:
+        return None, None
+    ts_part, id_part = page_cursor.rsplit("_", 1)
+    return datetime.strptime(ts_part, "%Y%m%d%H%M%S"), int(id_part)
+
+
+def history_page(prefix, limit_arg, cursor_ts=None, cursor_id=None):
+    """Build one page of history search results as a JSON-ready dict.
+
+    Raises mysql Error when the database cannot be queried.
+    """
+    try:
+        limit = int(limit_arg or HISTORY_PAGE_SIZE)
+    except ValueError:
+        limit = HISTORY_PAGE_SIZE
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+    try:
+        refresh_city_index()
+    except Error:
+        pass
+    # The index only suggests city names: other workers may have added
+    # cities since its last refresh, so the query below always runs
+    cities = city_index.search(prefix) if prefix else []
+
+    rows = search_history(prefix, limit + 1, cursor_ts, cursor_id)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last_id, _, _, _, last_ts = rows[-1]
+        next_cursor = f"{last_ts:%Y%m%d%H%M%S}_{last_id}"
+
+    results = [
+        {
+            "city": city,
+            "temperature": temperature,
+            "description": description,
+            "timestamp": timestamp.isoformat() if timestamp else None
+        }
+        for _, city, temperature, description, timestamp in rows
+    ]
+    return {"prefix": prefix, "cities": cities,
+            "results": results, "next_cursor": next_cursor}
@@ -2,10 +2,21 @@ CREATE DATABASE IF NOT EXISTS weather_app;
 
 USE weather_app;
 
+CREATE TABLE IF NOT EXISTS cities (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    name VARCHAR(255) NOT NULL,
+    UNIQUE KEY uq_cities_name (name)
+);
+
 CREATE TABLE IF NOT EXISTS weather_history (
     id INT AUTO_INCREMENT PRIMARY KEY,
-    city VARCHAR(100),
+    city_id INT NOT NULL,
     temperature VARCHAR(20),
     description VARCHAR(255),
-    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    row_key CHAR(32) NULL,
+    INDEX idx_city_timestamp (city_id, timestamp),
+    INDEX idx_timestamp (timestamp),
+    UNIQUE KEY uq_row_key (row_key),
+    FOREIGN KEY (city_id) REFERENCES cities (id)
 );
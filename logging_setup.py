@@ -0,0 +1,99 @@
+"""Structured, non-blocking logging.
+
+Request threads only enqueue records; a listener thread formats them and
+writes to stdout, so a slow log consumer never shows up as request latency.
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime
+
+from metrics import LOGS_DROPPED
+
+# Attributes every LogRecord has; anything else was passed through ``extra``
+_STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, including fields passed through ``extra``."""
+
+    def format(self, record):
+        entry = {
+            'timestamp': datetime.utcfromtimestamp(record.created).isoformat(timespec='milliseconds') + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, default=str, separators=(',', ':'))
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a fraction of INFO-and-below records for configured loggers."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rates.get(record.name)
+        if rate is None or random.random() < rate:
+            return True
+        LOGS_DROPPED.labels(reason='sampled').inc()
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops and counts records when its queue is full."""
+
+    def __init__(self, handler_queue, drop_reason='queue_full'):
+        super().__init__(handler_queue)
+        self.drop_reason = drop_reason
+
+    def prepare(self, record):
+        # Resolve the message and traceback here, since args and exc_info may
+        # not survive the hand-off, but leave all formatting to the listener
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOGS_DROPPED.labels(reason=self.drop_reason).inc()
+
+
+def configure_logging(level, log_format, queue_size, sample_rates):
+    """Route the root logger through a bounded queue; returns the started listener.
+
+    ``log_format`` is 'json' or plain text, and ``sample_rates`` maps logger
+    names to the fraction of their INFO-and-below records to keep.
+    """
+    log_handler = logging.StreamHandler(sys.stdout)
+    log_handler.setFormatter(
+        JsonFormatter() if log_format == 'json'
+        else logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    )
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rates))
+    logging.basicConfig(level=level, handlers=[queue_handler], force=True)
+    log_listener = logging.handlers.QueueListener(log_queue, log_handler, respect_handler_level=True)
+    log_listener.start()
+    return log_listener
@@ -0,0 +1,169 @@
+"""Prometheus metrics of the weather app, all registered on ``registry``."""
+import os
+
+from prometheus_client import Counter, Histogram, Gauge, CollectorRegistry, multiprocess
+
+from metrics_exposition import CachedExposition
+
+registry = CollectorRegistry()
+
+
+def parse_buckets(env_name, default):
+    """Read a comma-separated histogram bucket layout from the environment."""
+    raw = os.getenv(env_name)
+    if not raw:
+        return default
+    return tuple(sorted(float(bound) for bound in raw.split(',') if bound.strip()))
+
+
+def exponential_buckets(start, stop, schema):
+    """Buckets growing by 2 ** (2 ** -schema) from ``start`` to ``stop``.
+
+    This is the bucket growth factor Prometheus native histograms use, so
+    ``schema=2`` gives four buckets per doubling (about 19% relative error).
+    """
+    factor = 2 ** (2 ** -schema)
+    bounds = []
+    bound = start
+    while bound < stop:
+        bounds.append(round(bound, 6))
+        bound *= factor
+    bounds.append(stop)
+    return tuple(bounds)
+
+
+REQUEST_DURATION_BUCKETS = parse_buckets(
+    'REQUEST_DURATION_BUCKETS',
+    (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+# Upstream requests time out after 10 seconds
+API_RESPONSE_TIME_BUCKETS = parse_buckets(
+    'API_RESPONSE_TIME_BUCKETS',
+    (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0, 5.0, 10.0)
+)
+# High-resolution mode adds an exponential-bucket request histogram labelled
+# by endpoint only, for accurate tail quantiles at a bounded series count
+LATENCY_HIGHRES = os.getenv('LATENCY_HIGHRES', 'false').lower() == 'true'
+LATENCY_HIGHRES_SCHEMA = int(os.getenv('LATENCY_HIGHRES_SCHEMA', '2'))
+
+# Under gunicorn every worker writes its samples to mmap files in
+# PROMETHEUS_MULTIPROC_DIR (see gunicorn.conf.py) and scrapes aggregate them,
+# so /metrics reports the same totals whichever worker answers.
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+if PROMETHEUS_MULTIPROC_DIR:
+    exposition_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(exposition_registry)
+else:
+    exposition_registry = registry
+
+# Rendered payloads are reused for a few seconds to keep scrapes cheap
+METRICS_CACHE_SECONDS = float(os.getenv('METRICS_CACHE_SECONDS', '5'))
+metrics_exposition = CachedExposition(exposition_registry, METRICS_CACHE_SECONDS)
+
+REQUEST_COUNT = Counter(
+    'weather_requests_total', 'Total weather requests',
+    ['method', 'endpoint', 'status'], registry=registry
+)
+REQUEST_DURATION = Histogram(
+    'weather_request_duration_seconds', 'Request duration',
+    ['endpoint', 'method', 'status_class'],
+    buckets=REQUEST_DURATION_BUCKETS, registry=registry
+)
+REQUEST_DURATION_HIGHRES = Histogram(
+    'weather_request_duration_highres_seconds', 'High-resolution request duration',
+    ['endpoint'], buckets=exponential_buckets(0.001, 60.0, LATENCY_HIGHRES_SCHEMA),
+    registry=registry
+) if LATENCY_HIGHRES else None
+ACTIVE_CONNECTIONS = Gauge(
+    'weather_active_connections', 'Active database connections',
+    multiprocess_mode='livesum', registry=registry
+)
+API_RESPONSE_TIME = Histogram(
+    'weather_api_response_time_seconds', 'Weather API response time',
+    buckets=API_RESPONSE_TIME_BUCKETS, registry=registry
+)
+WEATHER_QUERIES = Counter(
+    'weather_queries_total', 'Total weather queries',
+    ['city', 'status'], registry=registry
+)
+DATABASE_QUERIES = Counter(
+    'database_queries_total', 'Total database queries',
+    ['operation'], registry=registry
+)
+CLOUDWATCH_METRICS = Counter(
+    'weather_cloudwatch_metrics_total', 'Custom metric events handled by the CloudWatch publisher',
+    ['outcome'], registry=registry
+)
+WEATHER_CACHE = Counter(
+    'weather_observation_cache_total', 'Weather observation cache lookups',
+    ['result'], registry=registry
+)
+RENDER_CACHE = Counter(
+    'weather_render_cache_total', 'Rendered page and fragment cache lookups',
+    ['kind', 'result'], registry=registry
+)
+RESPONSE_COMPRESSION = Counter(
+    'weather_response_compression_total', 'Responses considered for compression',
+    ['encoding', 'result'], registry=registry
+)
+LOGS_DROPPED = Counter(
+    'weather_logs_dropped_total', 'Log records dropped before being written',
+    ['reason'], registry=registry
+)
+TRACES_DROPPED = Counter(
+    'weather_traces_dropped_total', 'Sampled traces dropped because the export queue was full',
+    registry=registry
+)
+CLOUDWATCH_QUEUE_DEPTH = Gauge(
+    'weather_cloudwatch_queue_depth', 'Custom metric events waiting to be published',
+    multiprocess_mode='livesum', registry=registry
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'weather_requests_in_flight', 'Admitted requests currently being handled',
+    multiprocess_mode='livesum', registry=registry
+)
+REQUESTS_SHED = Counter(
+    'weather_requests_shed_total', 'Requests rejected by admission control',
+    ['reason'], registry=registry
+)
+RATE_LIMITED = Counter(
+    'weather_rate_limited_total', 'Requests denied by the per-client rate limiter',
+    ['endpoint'], registry=registry
+)
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    'weather_upstream_concurrency_limit', 'Adaptive limit on concurrent weather API calls',
+    multiprocess_mode='livesum', registry=registry
+)
+UPSTREAM_LIMIT_CHANGES = Counter(
+    'weather_upstream_limit_changes_total', 'Adjustments of the upstream concurrency limit',
+    ['direction'], registry=registry
+)
+UPSTREAM_SHED = Counter(
+    'weather_upstream_shed_total', 'Weather API calls refused because the limit was reached',
+    registry=registry
+)
+UPSTREAM_ATTEMPTS = Counter(
+    'weather_upstream_attempts_total', 'Weather API attempts by outcome',
+    ['outcome'], registry=registry
+)
+UPSTREAM_RETRIES_SKIPPED = Counter(
+    'weather_upstream_retries_skipped_total', 'Retryable failures that were not retried',
+    ['reason'], registry=registry
+)
+SPOOL_ROWS = Counter(
+    'weather_spool_rows_total', 'History rows written to or replayed from the local spool',
+    ['result'], registry=registry
+)
+SPOOL_BYTES = Gauge(
+    'weather_spool_bytes', 'Size of the history rows waiting in the local spool',
+    multiprocess_mode='livemostrecent', registry=registry
+)
+SPOOL_OLDEST_AGE = Gauge(
+    'weather_spool_oldest_age_seconds', 'Age of the oldest spooled history row',
+    multiprocess_mode='livemostrecent', registry=registry
+)
+REQUEST_QUEUE_TIME = Histogram(
+    'weather_request_queue_seconds', 'Time between X-Request-Start and the app seeing the request',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+    registry=registry
+)
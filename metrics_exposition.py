@@ -0,0 +1,84 @@
+"""Cached Prometheus exposition shared by the app and the gunicorn master.
+
+Rendering every series on each scrape costs real CPU once the registry is
+large, so the rendered payload (and its gzipped form) is reused for a short
+interval. The gunicorn master serves it on its own port so scrapes never
+occupy a request worker; the app's /metrics route uses the same cache.
+"""
+import gzip
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.openmetrics import exposition as openmetrics
+
+logger = logging.getLogger(__name__)
+
+
+class CachedExposition:
+    """Render a registry at most once per ``ttl`` seconds per format.
+
+    Scrapers asking for OpenMetrics get that format, which is the only one
+    that carries exemplars; everyone else gets the classic text format.
+    """
+
+    def __init__(self, registry, ttl):
+        self.registry = registry
+        self.ttl = ttl
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def render(self, accept_encoding='', accept=''):
+        """Return ``(body, headers)`` for a scrape, gzipped when accepted."""
+        use_openmetrics = 'application/openmetrics-text' in (accept or '')
+        with self._lock:
+            now = time.monotonic()
+            entry = self._cache.get(use_openmetrics)
+            if entry is None or now - entry['rendered_at'] >= self.ttl:
+                if use_openmetrics:
+                    payload = openmetrics.generate_latest(self.registry)
+                else:
+                    payload = generate_latest(self.registry)
+                entry = {'rendered_at': now, 'payload': payload, 'gzipped': None}
+                self._cache[use_openmetrics] = entry
+            headers = {
+                'Content-Type': (openmetrics.CONTENT_TYPE_LATEST if use_openmetrics
+                                 else CONTENT_TYPE_LATEST),
+                'Vary': 'Accept, Accept-Encoding'
+            }
+            if 'gzip' not in (accept_encoding or ''):
+                return entry['payload'], headers
+            if entry['gzipped'] is None:
+                entry['gzipped'] = gzip.compress(entry['payload'], compresslevel=5)
+            headers['Content-Encoding'] = 'gzip'
+            return entry['gzipped'], headers
+
+
+def start_metrics_server(port, exposition, addr='0.0.0.0'):
+    """Serve ``exposition`` at /metrics from a daemon thread."""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):  # pylint: disable=invalid-name
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body, headers = exposition.render(self.headers.get('Accept-Encoding', ''),
+                                              self.headers.get('Accept', ''))
+            self.send_response(200)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            pass
+
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True)
+    thread.start()
+    logger.info("Serving Prometheus metrics on port %d", port)
+    return server
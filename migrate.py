@@ -0,0 +1,210 @@
+"""Weather history schema: table creation and one-off migrations.
+
+The app only creates missing tables when it starts (create_tables) and logs
+an error while an existing database still needs upgrading. Upgrades run
+once per release through ``python migrate.py``, as the migration Job in
+terraform/eks.tf does, never in the gunicorn workers.
+
+Every step checks information_schema before it changes anything, so a run
+that was interrupted can simply be started again. A named lock keeps two
+runs from interleaving, and long backfills commit in batches of
+``--batch-size`` rows.
+"""
+import argparse
+import logging
+import os
+
+import mysql.connector
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = 'weather_app_migrate'
+
+CREATE_CITIES = """
+    CREATE TABLE IF NOT EXISTS cities (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        UNIQUE KEY uq_cities_name (name)
+    )
+"""
+CREATE_WEATHER_HISTORY = """
+    CREATE TABLE IF NOT EXISTS weather_history (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        city_id INT NOT NULL,
+        temperature VARCHAR(50),
+        description VARCHAR(255),
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        row_key CHAR(32) NULL,
+        INDEX idx_city_timestamp (city_id, timestamp),
+        INDEX idx_timestamp (timestamp),
+        UNIQUE KEY uq_row_key (row_key),
+        FOREIGN KEY (city_id) REFERENCES cities (id)
+    )
+"""
+
+
+def create_tables(cursor):
+    """Create the tables of a fresh database; existing tables are left alone."""
+    cursor.execute(CREATE_CITIES)
+    cursor.execute(CREATE_WEATHER_HISTORY)
+
+
+def column_exists(cursor, table, column):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.columns "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s",
+        (table, column)
+    )
+    return cursor.fetchone()[0] > 0
+
+
+def index_columns(cursor, table, index):
+    """Columns of ``index`` in order, or an empty list if there is no such index."""
+    cursor.execute(
+        "SELECT column_name FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s "
+        "ORDER BY seq_in_index",
+        (table, index)
+    )
+    return [row[0].lower() for row in cursor.fetchall()]
+
+
+def foreign_key_exists(cursor, table, column, referenced_table):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.key_column_usage "
+        "WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s "
+        "AND referenced_table_name = %s",
+        (table, column, referenced_table)
+    )
+    return cursor.fetchone()[0] > 0
+
+
+def pending_migrations(cursor):
+    """Names of the migrations the connected database still needs."""
+    pending = []
+    if (column_exists(cursor, 'weather_history', 'city')
+            or index_columns(cursor, 'weather_history', 'idx_city_timestamp')[:1] != ['city_id']
+            or not foreign_key_exists(cursor, 'weather_history', 'city_id', 'cities')):
+        pending.append('city_id')
+    if (not column_exists(cursor, 'weather_history', 'row_key')
+            or not index_columns(cursor, 'weather_history', 'uq_row_key')):
+        pending.append('row_key')
+    if not index_columns(cursor, 'weather_history', 'idx_timestamp'):
+        pending.append('timestamp_index')
+    return pending
+
+
+def backfill_city_ids(conn, cursor, batch_size):
+    """Point every legacy row at its ``cities`` entry, one id range at a time."""
+    # Older schemas allowed NULL cities; those rows map to an empty name
+    cursor.execute(
+        "INSERT IGNORE INTO cities (name) "
+        "SELECT DISTINCT COALESCE(city, '') FROM weather_history"
+    )
+    conn.commit()
+    cursor.execute("SELECT COALESCE(MIN(id), 0), COALESCE(MAX(id), 0) FROM weather_history")
+    low, high = cursor.fetchone()
+    for start in range(low, high + 1, batch_size):
+        cursor.execute(
+            "UPDATE weather_history h JOIN cities c ON c.name = COALESCE(h.city, '') "
+            "SET h.city_id = c.id "
+            "WHERE h.id BETWEEN %s AND %s AND h.city_id IS NULL",
+            (start, start + batch_size - 1)
+        )
+        conn.commit()
+        logger.info("Backfilled city_id up to id %d of %d", min(start + batch_size - 1, high), high)
+
+
+def migrate_city_column(conn, cursor, batch_size):
+    """Move a legacy ``weather_history.city`` string column onto ``cities``."""
+    if column_exists(cursor, 'weather_history', 'city'):
+        logger.info("Migrating weather_history.city to the cities table.")
+        if not column_exists(cursor, 'weather_history', 'city_id'):
+            cursor.execute("ALTER TABLE weather_history ADD COLUMN city_id INT NULL AFTER id")
+        backfill_city_ids(conn, cursor, batch_size)
+        # Rows written by older app versions since the last batch
+        cursor.execute(
+            "INSERT IGNORE INTO cities (name) SELECT DISTINCT COALESCE(city, '') "
+            "FROM weather_history WHERE city_id IS NULL"
+        )
+        cursor.execute(
+            "UPDATE weather_history h JOIN cities c ON c.name = COALESCE(h.city, '') "
+            "SET h.city_id = c.id WHERE h.city_id IS NULL"
+        )
+        conn.commit()
+        if index_columns(cursor, 'weather_history', 'idx_city_timestamp')[:1] == ['city']:
+            cursor.execute("DROP INDEX idx_city_timestamp ON weather_history")
+        cursor.execute(
+            "ALTER TABLE weather_history DROP COLUMN city, MODIFY city_id INT NOT NULL"
+        )
+    if not index_columns(cursor, 'weather_history', 'idx_city_timestamp'):
+        cursor.execute(
+            "ALTER TABLE weather_history ADD INDEX idx_city_timestamp (city_id, timestamp)"
+        )
+    if not foreign_key_exists(cursor, 'weather_history', 'city_id', 'cities'):
+        cursor.execute(
+            "ALTER TABLE weather_history ADD FOREIGN KEY (city_id) REFERENCES cities (id)"
+        )
+
+
+def migrate_row_key_column(cursor):
+    """Add the ``row_key`` column that makes spool replays idempotent."""
+    if not column_exists(cursor, 'weather_history', 'row_key'):
+        logger.info("Adding weather_history.row_key.")
+        cursor.execute("ALTER TABLE weather_history ADD COLUMN row_key CHAR(32) NULL")
+    if not index_columns(cursor, 'weather_history', 'uq_row_key'):
+        cursor.execute("ALTER TABLE weather_history ADD UNIQUE KEY uq_row_key (row_key)")
+
+
+def migrate_timestamp_index(cursor):
+    """Index ``timestamp`` alone so unfiltered history pages avoid a filesort."""
+    if not index_columns(cursor, 'weather_history', 'idx_timestamp'):
+        logger.info("Adding weather_history.idx_timestamp.")
+        cursor.execute("ALTER TABLE weather_history ADD INDEX idx_timestamp (timestamp)")
+
+
+def migrate(conn, batch_size=10000, lock_timeout=60):
+    """Bring the connected database up to the current schema."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, lock_timeout))
+    if cursor.fetchone()[0] != 1:
+        raise RuntimeError(f"Another migration holds the {LOCK_NAME} lock")
+    try:
+        create_tables(cursor)
+        migrate_city_column(conn, cursor, batch_size)
+        migrate_row_key_column(cursor)
+        migrate_timestamp_index(cursor)
+        conn.commit()
+    finally:
+        cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+        cursor.fetchall()
+        cursor.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--batch-size', type=int, default=10000,
+                        help='rows per backfill transaction')
+    parser.add_argument('--lock-timeout', type=int, default=60,
+                        help='seconds to wait for a concurrent run to finish')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    conn = mysql.connector.connect(
+        host=os.getenv('DB_HOST'),
+        port=int(os.getenv('DB_PORT', '3306')),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD'),
+        database=os.getenv('DB_NAME'),
+        connection_timeout=int(os.getenv('DB_CONNECT_TIMEOUT', '5'))
+    )
+    try:
+        migrate(conn, args.batch_size, args.lock_timeout)
+    finally:
+        conn.close()
+    logger.info("Database schema is up to date.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""Background stack sampler for profiling a worker process.
+
+One daemon thread per process takes every sample, for all profiles being
+collected at that moment. On-demand and continuous profiles therefore share
+a sampler, and the request that asks for a profile returns straight away.
+The thread sees every other OS thread, including the one a sync gunicorn
+worker handles requests on. Under gevent it is a native thread, so it keeps
+running while greenlets hold the hub, and it also walks the suspended
+greenlets through gc the way gevent.util does. That walk touches every
+object in the process, so the sampling rate is capped at
+``greenlet_max_hz`` there.
+
+The sampler sleeps on a lock while no profile is running. A forked child
+starts its own thread the first time ensure_started() runs in it.
+"""
+import _thread
+import collections
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import types
+
+logger = logging.getLogger(__name__)
+
+
+def collapse_stack(thread_name, frame):
+    """Render a frame as a root-first ``thread;file:function;...`` stack."""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    parts.append(thread_name)
+    return ";".join(reversed(parts))
+
+
+def format_collapsed(counts):
+    """Format stack counts in the folded format flamegraph tools read."""
+    return "".join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+
+def write_profile(directory, name, counts, keep_prefix, keep):
+    """Write folded stacks to ``directory/name``, keeping the newest ``keep`` files.
+
+    Only files starting with ``keep_prefix`` are pruned. The file is renamed
+    into place, so readers never see a partial profile.
+    """
+    path = os.path.join(directory, name)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as handle:
+            handle.write(format_collapsed(counts))
+        os.replace(path + ".tmp", path)
+        own = sorted(entry for entry in os.listdir(directory)
+                     if entry.startswith(keep_prefix) and entry.endswith(".folded"))
+        for entry in own[:-keep]:
+            os.remove(os.path.join(directory, entry))
+    except OSError as err:
+        logger.error("Failed to write profile %s: %s", path, err)
+
+
+def _gevent_patched():
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    return gevent_monkey is not None and gevent_monkey.is_module_patched('threading')
+
+
+def _native_thread_module():
+    """The real ``_thread`` module, even after gevent has monkey-patched it."""
+    if _gevent_patched():
+        from gevent import monkey  # pylint: disable=import-outside-toplevel
+        return types.SimpleNamespace(**{
+            name: monkey.get_original('_thread', name)
+            for name in ('start_new_thread', 'allocate_lock', 'get_ident')
+        })
+    return _thread
+
+
+class ProfileSession:
+    """Samples collected at ``hz`` until ``seconds`` from now."""
+
+    def __init__(self, seconds, hz, on_done, repeat=False):
+        self.seconds = seconds
+        self.hz = hz
+        self.on_done = on_done
+        self.repeat = repeat
+        self.deadline = time.monotonic() + seconds
+        self.next_due = time.monotonic()
+        self.counts = collections.Counter()
+
+
+class StackSampler:
+    """Collect any number of concurrent profiles from one sampling thread."""
+
+    def __init__(self, greenlet_max_hz=10.0):
+        self.greenlet_max_hz = greenlet_max_hz
+        self.greenlets = False
+        self._continuous = None
+        self._sessions = []
+        self._pid = None
+        self._lock = _thread.allocate_lock()
+        self._wakeup = None
+
+    def set_continuous(self, seconds, hz, on_done):
+        """Profile back to back in windows of ``seconds``, passing each to ``on_done``."""
+        self._continuous = (seconds, hz, on_done)
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        # Checked here rather than at import: gunicorn patches gevent workers
+        # after the config file, and possibly this module, has been loaded
+        native = _native_thread_module()
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self.greenlets = _gevent_patched()
+            self._lock = native.allocate_lock()
+            self._wakeup = native.allocate_lock()
+            self._wakeup.acquire()
+            self._sessions = []
+            if self._continuous is not None:
+                seconds, hz, on_done = self._continuous
+                self._sessions.append(ProfileSession(seconds, self._cap(hz), on_done,
+                                                     repeat=True))
+            native.start_new_thread(self._run, (native.get_ident,))
+            self._pid = os.getpid()
+
+    def _cap(self, hz):
+        return min(hz, self.greenlet_max_hz) if self.greenlets else hz
+
+    def start(self, seconds, hz, on_done):
+        """Begin a profile; ``on_done(counts)`` runs on the sampler thread at the end.
+
+        Returns the session, whose ``hz`` may be lower than asked for under
+        gevent.
+        """
+        self.ensure_started()
+        session = ProfileSession(seconds, self._cap(hz), on_done)
+        with self._lock:
+            self._sessions.append(session)
+        self._wake()
+        return session
+
+    def _wake(self):
+        try:
+            self._wakeup.release()
+        except RuntimeError:
+            # Already woken and not yet asleep again
+            pass
+
+    def _run(self, get_ident):
+        me = get_ident()
+        while True:
+            with self._lock:
+                sessions = list(self._sessions)
+            now = time.monotonic()
+            due = [session for session in sessions if session.next_due <= now]
+            if due:
+                stacks = self._sample(me)
+                for session in due:
+                    session.counts.update(stacks)
+                    session.next_due = now + 1.0 / session.hz
+            for session in sessions:
+                if session.deadline <= now:
+                    self._finish(session)
+            with self._lock:
+                wake_at = [session.next_due for session in self._sessions]
+            timeout = max(0.0, min(wake_at) - time.monotonic()) if wake_at else -1
+            self._wakeup.acquire(timeout=timeout)
+
+    def _finish(self, session):
+        with self._lock:
+            self._sessions.remove(session)
+            if session.repeat:
+                self._sessions.append(ProfileSession(session.seconds, session.hz,
+                                                     session.on_done, repeat=True))
+        try:
+            session.on_done(session.counts)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Profile callback failed")
+
+    def _sample(self, me):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = [
+            collapse_stack(names.get(ident, f"thread-{ident}"), frame)
+            for ident, frame in sys._current_frames().items()  # pylint: disable=protected-access
+            if ident != me
+        ]
+        if self.greenlets:
+            from greenlet import greenlet  # pylint: disable=import-outside-toplevel
+            # The running greenlet has no gr_frame; its stack is its thread's
+            stacks.extend(
+                collapse_stack(type(obj).__name__, obj.gr_frame)
+                for obj in gc.get_objects()
+                if isinstance(obj, greenlet) and obj.gr_frame is not None
+            )
+        return stacks
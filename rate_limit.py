@@ -0,0 +1,91 @@
+"""Token-bucket rate limiting with pluggable bucket stores.
+
+Every backend exposes ``consume(key)`` returning ``(allowed, retry_after)``
+and does O(1) work per call:
+
+* ``SharedMemoryBuckets`` keeps a fixed-size table in an mmap'd file so
+  all gunicorn workers on a node draw from the same buckets.
+* ``InMemoryBuckets`` is per-process. It stands in for a store shared by
+  every pod (Redis or similar), which only has to implement ``consume``.
+"""
+import collections
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+def _refill(tokens, last, now, rate, burst):
+    return min(burst, tokens + max(0.0, now - last) * rate)
+
+
+class InMemoryBuckets:
+    """Buckets for the most recently seen ``max_keys`` clients of this process."""
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, cost=1.0):
+        now = time.time()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = _refill(tokens, last, now, self.rate, self.burst)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0.0 if allowed else (cost - tokens) / self.rate
+
+
+class SharedMemoryBuckets:
+    """Buckets in a memory-mapped file shared by every process on the host.
+
+    The file holds ``slots`` fixed-size records (key fingerprint, tokens,
+    last refill time) addressed by a hash of the key. Each update holds a
+    byte-range lock on its record only. When two clients hash to the same
+    slot the newcomer takes it over with a full bucket, which can only
+    make the limiter more lenient, never wrongly deny anyone.
+    """
+
+    RECORD = struct.Struct('<8sdd')
+
+    def __init__(self, path, rate, burst, slots=65536):
+        self.rate = rate
+        self.burst = burst
+        self.slots = slots
+        size = self.RECORD.size * slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+        # fcntl locks are per process, so threads in one worker also need this
+        self._lock = threading.Lock()
+
+    def consume(self, key, cost=1.0):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        fingerprint = digest[:8]
+        offset = int.from_bytes(digest[8:], 'little') % self.slots * self.RECORD.size
+        now = time.time()
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self.RECORD.size, offset, os.SEEK_SET)
+            try:
+                stored, tokens, last = self.RECORD.unpack_from(self._map, offset)
+                if stored != fingerprint:
+                    tokens, last = self.burst, now
+                tokens = _refill(tokens, last, now, self.rate, self.burst)
+                allowed = tokens >= cost
+                if allowed:
+                    tokens -= cost
+                self.RECORD.pack_into(self._map, offset, fingerprint, tokens, now)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self.RECORD.size, offset, os.SEEK_SET)
+        return allowed, 0.0 if allowed else (cost - tokens) / self.rate
@@ -0,0 +1,332 @@
+"""Durable append-only spool of JSON records on local disk.
+
+Each process appends to its own segment file (``<start>-<pid>.open``) so
+workers never interleave writes. Appends are group-committed: a flusher
+thread fsyncs whatever has been written at most every ``fsync_interval``
+seconds and ``append`` returns once its record is on disk, so a burst of
+writers shares one fsync. Segments are sealed (renamed to ``.ready``) once
+they are ``segment_seconds`` old or ``segment_bytes`` large. Once the
+segments on disk add up to ``max_bytes``, appends fail with ENOSPC.
+
+Readers take sealed segments oldest first, under an exclusive lock so that
+only one process on the host drains the spool at a time, and delete each
+segment after its records have been applied. Records that can never be
+applied are moved to a ``.dead`` file instead. Segments left ``.open`` by a
+process that died are sealed by the reader once they have gone untouched
+for a while. SpoolReplayer does that draining from a daemon thread.
+"""
+import errno
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class DiskSpool:
+    """Append records to ``directory`` and hand sealed segments to a reader."""
+
+    def __init__(self, directory, fsync_interval=0.05, segment_seconds=5.0,
+                 segment_bytes=4 * 1024 * 1024, append_timeout=5.0, max_bytes=None):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.append_timeout = append_timeout
+        self.max_bytes = max_bytes
+        self._usage = (0, float('-inf'))
+        self._cond = threading.Condition()
+        self._fd = None
+        self._path = None
+        self._opened_at = 0.0
+        self._size = 0
+        self._written = 0
+        self._synced = 0
+        self._pid = None
+
+    def _ensure_started(self):
+        # Forked workers must not share the parent's segment or flusher
+        if self._pid == os.getpid():
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._fd = None
+        self._written = self._synced = 0
+        self._pid = os.getpid()
+        threading.Thread(target=self._flush_loop, name='spool-flusher', daemon=True).start()
+
+    def append(self, record):
+        """Write ``record`` and return once it has been fsynced.
+
+        Raises OSError if the spool is full, the disk write fails or the
+        fsync does not happen within ``append_timeout``.
+        """
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._cond:
+            self._ensure_started()
+            if self.is_full():
+                raise OSError(errno.ENOSPC, "History spool is full")
+            if self._fd is None:
+                self._open_segment()
+            os.write(self._fd, line)
+            self._size += len(line)
+            self._written += 1
+            sequence = self._written
+            self._cond.notify_all()
+            if not self._cond.wait_for(lambda: self._synced >= sequence,
+                                       timeout=self.append_timeout):
+                raise OSError("Timed out waiting for the spool to be fsynced")
+
+    def _open_segment(self):
+        self._path = os.path.join(self.directory, f"{time.time():017.6f}-{os.getpid()}.open")
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        self._opened_at = time.monotonic()
+        self._size = 0
+
+    def _seal_segment(self):
+        """Close the current segment and publish it to readers. Caller holds _cond."""
+        os.fsync(self._fd)
+        os.close(self._fd)
+        os.rename(self._path, self._path[:-len('.open')] + '.ready')
+        self._fsync_directory()
+        self._fd = None
+
+    def _fsync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._written > self._synced,
+                                    timeout=self.segment_seconds)
+            # Give concurrent appenders a moment to join this fsync
+            time.sleep(self.fsync_interval)
+            with self._cond:
+                if self._fd is None:
+                    continue
+                target = self._written
+                try:
+                    too_old = time.monotonic() - self._opened_at >= self.segment_seconds
+                    if too_old or self._size >= self.segment_bytes:
+                        self._seal_segment()
+                    else:
+                        os.fsync(self._fd)
+                except OSError:
+                    # Appenders time out and report the failure themselves
+                    continue
+                self._synced = target
+                self._cond.notify_all()
+
+    def close(self):
+        """Seal the current segment, e.g. at process exit."""
+        with self._cond:
+            if self._fd is not None and self._pid == os.getpid():
+                self._seal_segment()
+                self._synced = self._written
+                self._cond.notify_all()
+
+    def is_full(self):
+        """True once the spool holds ``max_bytes``; the size is re-read every second."""
+        if not self.max_bytes:
+            return False
+        size, checked_at = self._usage
+        if time.monotonic() - checked_at >= 1.0:
+            size = self.stats()[0]
+            self._usage = (size, time.monotonic())
+        return size >= self.max_bytes
+
+    def probe(self):
+        """Raise OSError unless a record could be appended right now."""
+        os.makedirs(self.directory, exist_ok=True)
+        if self.is_full():
+            raise OSError(errno.ENOSPC, "History spool is full")
+        path = os.path.join(self.directory, f".probe-{os.getpid()}")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, b'\n')
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+            os.remove(path)
+
+    @contextmanager
+    def reader(self):
+        """Yield True if this process may drain the spool, False if another is."""
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, 'replay.lock'), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def ready_segments(self, orphan_after=60.0):
+        """Sealed segments, oldest first, after sealing abandoned ``.open`` ones."""
+        now = time.time()
+        for path in glob.glob(os.path.join(self.directory, '*.open')):
+            if path == self._path and self._fd is not None:
+                continue
+            try:
+                if now - os.path.getmtime(path) >= max(orphan_after, 2 * self.segment_seconds):
+                    os.rename(path, path[:-len('.open')] + '.ready')
+            except FileNotFoundError:
+                pass
+        return sorted(glob.glob(os.path.join(self.directory, '*.ready')))
+
+    def dead_letter(self, path, records):
+        """Keep ``records`` from segment ``path`` in a ``.dead`` file for inspection.
+
+        Dead-letter files are never replayed or counted in the spool size.
+        """
+        dead_path = os.path.splitext(path)[0] + '.dead'
+        data = b''.join((json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+                        for record in records)
+        fd = os.open(dead_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._fsync_directory()
+        return dead_path
+
+    @staticmethod
+    def read_segment(path):
+        """Records in a segment; a torn final line from a crash is skipped."""
+        records = []
+        with open(path, 'rb') as handle:
+            for line in handle:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+        return records
+
+    def stats(self):
+        """``(bytes, oldest segment start time)`` across every segment on disk.
+
+        Only file metadata is read, so this stays cheap however large the
+        spool grows during an outage.
+        """
+        size, oldest = 0, None
+        for pattern in ('*.ready', '*.open'):
+            for path in glob.glob(os.path.join(self.directory, pattern)):
+                try:
+                    segment_size = os.path.getsize(path)
+                except FileNotFoundError:
+                    continue
+                size += segment_size
+                if segment_size:
+                    stamp = float(os.path.basename(path).split('-', 1)[0])
+                    oldest = stamp if oldest is None else min(oldest, stamp)
+        return size, oldest
+
+
+class SpoolReplayer:
+    """Drain a DiskSpool from a daemon thread through injected callables.
+
+    Every ``interval`` seconds one process per host takes the spool's reader
+    lock, reports the spool's size to ``on_stats(bytes, oldest)`` and, while
+    ``can_write()`` is true, passes sealed segments to ``write_batch(records)``
+    in batches of ``batch_size``. A segment is deleted only after each of its
+    records is either written or, when ``is_poison(err)`` blames that record
+    alone for the failure, dead-lettered and counted through ``on_dead(count)``.
+    """
+
+    def __init__(self, spool, interval, batch_size, *, write_batch, is_poison,
+                 can_write=None, on_dead=None, on_stats=None):
+        self.spool = spool
+        self.interval = interval
+        self.batch_size = batch_size
+        self.write_batch = write_batch
+        self.is_poison = is_poison
+        self.can_write = can_write or (lambda: True)
+        self.on_dead = on_dead
+        self.on_stats = on_stats
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        if self.spool is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name='spool-replayer', daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.replay()
+            except Exception as err:  # pylint: disable=broad-except
+                logger.error("Spool replay failed: %s", err)
+
+    def replay(self):
+        """Replay what is ready now; returns the number of records written."""
+        replayed = 0
+        with self.spool.reader() as is_reader:
+            if not is_reader:
+                return 0
+            try:
+                if self.can_write():
+                    for path in self.spool.ready_segments():
+                        replayed += self._replay_segment(path)
+            finally:
+                if self.on_stats is not None:
+                    self.on_stats(*self.spool.stats())
+        if replayed:
+            logger.info("Replayed %d spooled records", replayed)
+        return replayed
+
+    def _replay_segment(self, path):
+        """Write one segment and remove it; returns the records written.
+
+        A batch that fails because of a poison record is retried record by
+        record so the others still go in. Any other error propagates and
+        leaves the segment for the next pass, so ``write_batch`` has to
+        tolerate records it has already written.
+        """
+        records = self.spool.read_segment(path)
+        written = 0
+        dead = []
+        for start in range(0, len(records), self.batch_size):
+            batch = records[start:start + self.batch_size]
+            try:
+                self.write_batch(batch)
+                written += len(batch)
+                continue
+            except Exception as err:  # pylint: disable=broad-except
+                if not self.is_poison(err):
+                    raise
+            for record in batch:
+                try:
+                    self.write_batch([record])
+                    written += 1
+                except Exception as err:  # pylint: disable=broad-except
+                    if not self.is_poison(err):
+                        raise
+                    logger.error("Spooled record rejected: %s", err)
+                    dead.append(record)
+        if dead:
+            dead_path = self.spool.dead_letter(path, dead)
+            if self.on_dead is not None:
+                self.on_dead(len(dead))
+            logger.error("Moved %d rejected records to %s", len(dead), dead_path)
+        os.remove(path)
+        return written
@@ -0,0 +1,77 @@
+let filterTimer = null;
+let initialHistory = null;
+let nextCursor = null;
+let searchController = null;
+
+function filterHistory() {
+    clearTimeout(filterTimer);
+    filterTimer = setTimeout(function () { searchHistory(false); }, 250);
+}
+function searchHistory(append) {
+    const table = document.getElementById("historyTable");
+    const prefix = document.getElementById("historySearch").value.trim();
+    const more = document.getElementById("historyMore");
+    if (initialHistory === null) {
+        initialHistory = table.innerHTML;
+    }
+    // Only the latest search may touch the table; a slower earlier
+    // response must not overwrite newer results
+    if (searchController) {
+        searchController.abort();
+    }
+    searchController = null;
+    if (!prefix) {
+        table.innerHTML = initialHistory;
+        more.style.display = "none";
+        return;
+    }
+
+    let url = "/history/search?prefix=" + encodeURIComponent(prefix);
+    if (append && nextCursor) {
+        url += "&cursor=" + encodeURIComponent(nextCursor);
+    }
+    const controller = new AbortController();
+    searchController = controller;
+    fetch(url, { signal: controller.signal })
+        .then(function (resp) { return resp.json(); })
+        .then(function (data) {
+            if (controller !== searchController) {
+                return;
+            }
+            if (!append) {
+                while (table.rows.length > 1) {
+                    table.deleteRow(1);
+                }
+            }
+            (data.results || []).forEach(function (entry) {
+                const row = table.insertRow(-1);
+                [entry.city, entry.temperature, entry.description, entry.timestamp]
+                    .forEach(function (value) { row.insertCell(-1).textContent = value; });
+            });
+            nextCursor = data.next_cursor;
+            more.style.display = nextCursor ? "" : "none";
+        })
+        .catch(function (err) {
+            if (err.name !== "AbortError") {
+                throw err;
+            }
+        });
+}
+function toggleTheme() {
+    const body = document.body;
+    const checkbox = document.getElementById("toggleDark");
+    body.classList.toggle("dark-theme");
+
+    if (body.classList.contains("dark-theme")) {
+        localStorage.setItem("theme", "dark");
+    } else {
+        localStorage.setItem("theme", "light");
+    }
+}
+window.onload = function () {
+    const savedTheme = localStorage.getItem("theme");
+    if (savedTheme === "dark") {
+        document.body.classList.add("dark-theme");
+        document.getElementById("toggleDark").checked = true;
+    }
+};
@@ -0,0 +1,303 @@
+"""Fingerprinted static assets: the build step and the layer that serves them.
+
+``python static_assets.py`` (run during the Docker build) copies static/ into
+static/dist/ with a content hash in every filename, minifies the CSS and JS
+bundles the templates link to, renders WebP and AVIF
+variants of raster images at several widths, precompresses text assets as
+.gz/.br and records the result in static/dist/manifest.json.
+
+Because a fingerprinted URL never changes content, StaticAssets can answer
+/static/dist/ requests in front of Flask with a one-year immutable lifetime;
+those requests never reach the request hooks, the database or a template.
+Bodies are read into memory when the app starts, so a hit costs no file
+I/O. Set ASSET_BASE_URL to a CDN in front of the same files (see
+terraform/cdn.tf) to keep them off the pods entirely.
+"""
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import shutil
+
+from compression import choose_encoding
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional brotli support
+    brotli = None
+try:
+    import rcssmin
+    import rjsmin
+except ImportError:  # pragma: no cover - bundles are then shipped unminified
+    rcssmin = None
+    rjsmin = None
+try:
+    from PIL import Image, features
+except ImportError:  # pragma: no cover - Pillow is only needed to build
+    Image = None
+    features = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+IMAGE_WIDTHS = (640, 1280, 1920)
+IMAGE_FORMATS = (('avif', 'image/avif', {'quality': 50}),
+                 ('webp', 'image/webp', {'quality': 75, 'method': 6}))
+RASTER_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+PRECOMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+mimetypes.add_type('image/avif', '.avif')
+mimetypes.add_type('image/webp', '.webp')
+
+
+def fingerprint(name, data):
+    """``rain.jpg`` -> ``rain.<hash>.jpg`` for the given content."""
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha1(data).hexdigest()[:12]}{ext}"
+
+
+def _write(dest, relpath, data):
+    path = os.path.join(dest, relpath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as handle:
+        handle.write(data)
+
+
+def minify(ext, data):
+    """Minify CSS or JS source; other content is returned unchanged."""
+    if ext == '.css' and rcssmin is not None:
+        return rcssmin.cssmin(data.decode('utf-8')).encode('utf-8')
+    if ext == '.js' and rjsmin is not None:
+        return rjsmin.jsmin(data.decode('utf-8')).encode('utf-8')
+    return data
+
+
+def _precompress(dest, relpath, data):
+    encoded = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encoded['.br'] = brotli.compress(data, quality=11)
+    for suffix, body in encoded.items():
+        if len(body) < len(data):
+            _write(dest, relpath + suffix, body)
+
+
+def _image_variants(dest, relpath, data):
+    """Write resized AVIF/WebP copies and return their srcset entries."""
+    variants = {}
+    with Image.open(io.BytesIO(data)) as original:
+        rgb = original.convert('RGB')
+        widths = sorted({w for w in IMAGE_WIDTHS if w < original.width} | {original.width})
+        stem = os.path.splitext(relpath)[0]
+        for fmt, _, options in IMAGE_FORMATS:
+            if not features.check(fmt):
+                logger.warning("Pillow has no %s support, skipping %s variants", fmt, fmt)
+                continue
+            entries = []
+            for width in widths:
+                height = round(original.height * width / original.width)
+                resized = rgb.resize((width, height), Image.Resampling.LANCZOS)
+                buffer = io.BytesIO()
+                resized.save(buffer, format=fmt.upper(), **options)
+                name = fingerprint(f"{stem}-{width}.{fmt}", buffer.getvalue())
+                _write(dest, name, buffer.getvalue())
+                entries.append([width, name])
+            variants[fmt] = entries
+    return variants
+
+
+def build(source, dest):
+    """Rebuild ``dest`` from ``source`` and return the manifest."""
+    manifest = {'files': {}, 'images': {}}
+    if os.path.isdir(dest):
+        shutil.rmtree(dest)
+    os.makedirs(dest)
+    dest_abs = os.path.abspath(dest)
+    for root, dirs, files in os.walk(source):
+        dirs[:] = sorted(d for d in dirs
+                         if os.path.abspath(os.path.join(root, d)) != dest_abs)
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            relpath = os.path.relpath(path, source).replace(os.sep, '/')
+            ext = os.path.splitext(filename)[1].lower()
+            with open(path, 'rb') as handle:
+                data = minify(ext, handle.read())
+            name = fingerprint(relpath, data)
+            _write(dest, name, data)
+            manifest['files'][relpath] = name
+            if ext in PRECOMPRESS_EXTENSIONS:
+                _precompress(dest, name, data)
+            elif ext in RASTER_EXTENSIONS and Image is not None:
+                manifest['images'][relpath] = _image_variants(dest, relpath, data)
+    with open(os.path.join(dest, MANIFEST_NAME), 'w', encoding='utf-8') as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+    return manifest
+
+
+class AssetManifest:
+    """Maps source asset names to fingerprinted URLs.
+
+    Without a built manifest every lookup returns None so callers can fall
+    back to Flask's own static route, which keeps local development working.
+    """
+
+    def __init__(self, path, base_url='/static/dist/'):
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.files = {}
+        self.images = {}
+        self.version = ''
+        try:
+            with open(path, 'rb') as handle:
+                raw = handle.read()
+        except FileNotFoundError:
+            return
+        manifest = json.loads(raw)
+        self.files = manifest.get('files', {})
+        self.images = manifest.get('images', {})
+        self.version = hashlib.sha1(raw).hexdigest()[:12]
+
+    def url(self, name):
+        built = self.files.get(name)
+        return self.base_url + built if built else None
+
+    def sources(self, name):
+        """``[(mime type, srcset), ...]`` for a ``<picture>``, best format first."""
+        variants = self.images.get(name, {})
+        sources = []
+        for fmt, mime, _ in IMAGE_FORMATS:
+            if variants.get(fmt):
+                srcset = ', '.join(f"{self.base_url}{file} {width}w"
+                                   for width, file in variants[fmt])
+                sources.append((mime, srcset))
+        return sources
+
+
+class StaticAssets:
+    """Serve the built directory under ``prefix`` ahead of ``wsgi_app``.
+
+    Files are indexed once at startup, the way WhiteNoise does, and their
+    bodies are loaded into memory smallest first until ``memory_bytes`` is
+    used up. Precompressed .br/.gz siblings are picked from Accept-Encoding.
+    Bodies that did not fit go through wsgi.file_wrapper so gunicorn can use
+    sendfile().
+    """
+
+    def __init__(self, wsgi_app, directory, prefix='/static/dist/',
+                 memory_bytes=64 * 1024 * 1024):
+        self.wsgi_app = wsgi_app
+        self.prefix = prefix
+        self.files = {}
+        self.memory_bytes = 0
+        if os.path.isdir(directory):
+            self._index(directory)
+            self._load(memory_bytes)
+
+    def _index(self, directory):
+        encodings = {'.br': 'br', '.gz': 'gzip'}
+        for root, _, files in os.walk(directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                relpath = os.path.relpath(path, directory).replace(os.sep, '/')
+                base, suffix = os.path.splitext(relpath)
+                if relpath == MANIFEST_NAME or (suffix in encodings
+                                                and os.path.exists(os.path.join(directory, base))):
+                    continue
+                stat = os.stat(path)
+                etag = f"{stat.st_size:x}-{int(stat.st_mtime):x}"
+                representations = {None: [path, stat.st_size, f'"{etag}"', None]}
+                for suffix, encoding in encodings.items():
+                    if os.path.exists(path + suffix):
+                        representations[encoding] = [path + suffix,
+                                                     os.path.getsize(path + suffix),
+                                                     f'"{etag}-{encoding}"', None]
+                self.files[relpath] = {
+                    'type': mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                    'representations': representations
+                }
+
+    def _load(self, budget):
+        """Read bodies into memory, smallest first, while they fit in ``budget``."""
+        candidates = sorted((representation for entry in self.files.values()
+                             for representation in entry['representations'].values()),
+                            key=lambda representation: representation[1])
+        for representation in candidates:
+            if self.memory_bytes + representation[1] > budget:
+                break
+            with open(representation[0], 'rb') as handle:
+                representation[3] = handle.read()
+            self.memory_bytes += len(representation[3])
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.prefix):
+            return self.wsgi_app(environ, start_response)
+        entry = self.files.get(path[len(self.prefix):])
+        if entry is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain'),
+                                             ('Content-Length', '9')])
+            return [b'Not Found']
+        if environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Allow', 'GET, HEAD'),
+                                                      ('Content-Length', '0')])
+            return []
+
+        representations = entry['representations']
+        encoding = None
+        if len(representations) > 1:
+            encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING'),
+                                       supported=tuple(e for e in representations if e))
+        file_path, size, etag, body = representations[encoding]
+        headers = [('Content-Type', entry['type']), ('Cache-Control', IMMUTABLE),
+                   ('ETag', etag)]
+        if len(representations) > 1:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if etag in environ.get('HTTP_IF_NONE_MATCH', ''):
+            start_response('304 Not Modified', headers)
+            return []
+
+        if encoding is not None:
+            headers.append(('Content-Encoding', encoding))
+        headers.append(('Content-Length', str(size)))
+        start_response('200 OK', headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [body] if body is not None else _file_body(environ, file_path)
+
+
+def _file_body(environ, path):
+    handle = open(path, 'rb')  # pylint: disable=consider-using-with
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        return file_wrapper(handle, 65536)
+    return _read_chunks(handle)
+
+
+def _read_chunks(handle, size=65536):
+    with handle:
+        while True:
+            chunk = handle.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('--source', default=os.path.join(here, 'static'))
+    parser.add_argument('--dest', default=os.path.join(here, 'static', 'dist'))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if not os.path.isdir(args.source):
+        os.makedirs(args.source)
+    manifest = build(args.source, args.dest)
+    logger.info("Built %d assets (%d images) into %s",
+                len(manifest['files']), len(manifest['images']), args.dest)
+
+
+if __name__ == '__main__':
+    main()
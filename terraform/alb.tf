@@ -46,7 +46,7 @@ resource "aws_lb_target_group" "app" {
     unhealthy_threshold = 2
     timeout             = 5
     interval            = 30
-    path                = "/"
+    path                = "/readyz"
     protocol            = "HTTP"
     matcher             = "200"
   }
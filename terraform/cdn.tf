@@ -0,0 +1,75 @@
+# ============================================================================
+# CloudFront for fingerprinted static assets (optional)
+# ============================================================================
+
+# /static/dist/* is cached at the edge for as long as the app's immutable
+# Cache-Control allows; the Deployment points ASSET_BASE_URL here, so asset
+# requests stop reaching the pods. Every other path is passed through
+# uncached.
+data "aws_cloudfront_cache_policy" "caching_optimized" {
+  name = "Managed-CachingOptimized"
+}
+
+data "aws_cloudfront_cache_policy" "caching_disabled" {
+  name = "Managed-CachingDisabled"
+}
+
+resource "aws_cloudfront_distribution" "assets" {
+  count = var.enable_asset_cdn ? 1 : 0
+
+  enabled         = true
+  comment         = "${var.project_name} static assets (${var.environment})"
+  is_ipv6_enabled = true
+  http_version    = "http2and3"
+  price_class     = var.asset_cdn_price_class
+
+  # The ALB's certificate does not cover its own DNS name, so HTTPS to the
+  # origin needs asset_cdn_origin_domain set to a name it does cover
+  origin {
+    origin_id   = "alb"
+    domain_name = var.asset_cdn_origin_domain != "" ? var.asset_cdn_origin_domain : aws_lb.main.dns_name
+
+    custom_origin_config {
+      http_port              = 80
+      https_port             = 443
+      origin_protocol_policy = var.asset_cdn_origin_domain != "" ? "https-only" : "http-only"
+      origin_ssl_protocols   = ["TLSv1.2"]
+    }
+  }
+
+  ordered_cache_behavior {
+    path_pattern           = "/static/dist/*"
+    target_origin_id       = "alb"
+    viewer_protocol_policy = "redirect-to-https"
+    allowed_methods        = ["GET", "HEAD"]
+    cached_methods         = ["GET", "HEAD"]
+    cache_policy_id        = data.aws_cloudfront_cache_policy.caching_optimized.id
+    # The app already serves precompressed .br/.gz variants
+    compress = false
+  }
+
+  default_cache_behavior {
+    target_origin_id       = "alb"
+    viewer_protocol_policy = "redirect-to-https"
+    allowed_methods        = ["GET", "HEAD"]
+    cached_methods         = ["GET", "HEAD"]
+    cache_policy_id        = data.aws_cloudfront_cache_policy.caching_disabled.id
+  }
+
+  restrictions {
+    geo_restriction {
+      restriction_type = "none"
+    }
+  }
+
+  viewer_certificate {
+    cloudfront_default_certificate = true
+  }
+
+  tags = {
+    Name        = "${var.project_name}-assets-${var.environment}"
+    Environment = var.environment
+    Project     = var.project_name
+    ManagedBy   = "Terraform"
+  }
+}
@@ -485,11 +485,60 @@ resource "kubernetes_secret" "db_credentials" {
   type = "Opaque"
 }
 
+# ============================================================================
+# Schema Migration Job
+# ============================================================================
+
+# Upgrades the database schema once per image (see migrate.py) before the
+# Deployment rolls out; the app itself only creates missing tables
+resource "kubernetes_job_v1" "migrate" {
+  metadata {
+    name      = "${var.project_name}-migrate"
+    namespace = kubernetes_namespace.app.metadata[0].name
+  }
+
+  spec {
+    backoff_limit = 3
+
+    template {
+      metadata {
+        labels = {
+          app = "${var.project_name}-migrate"
+        }
+      }
+
+      spec {
+        restart_policy = "Never"
+
+        container {
+          name    = "migrate"
+          image   = "${var.docker_image != "" ? var.docker_image : "pankswork/weather-app"}:${var.docker_image_tag}"
+          command = ["python", "migrate.py"]
+
+          env_from {
+            secret_ref {
+              name = kubernetes_secret.db_credentials.metadata[0].name
+            }
+          }
+        }
+      }
+    }
+  }
+
+  wait_for_completion = true
+
+  timeouts {
+    create = "30m"
+    update = "30m"
+  }
+}
+
 # ============================================================================
 # Kubernetes Deployment
 # ============================================================================
 
 resource "kubernetes_deployment" "app" {
+
   metadata {
     name      = "${var.project_name}-app"
     namespace = kubernetes_namespace.app.metadata[0].name
@@ -514,6 +563,11 @@ resource "kubernetes_deployment" "app" {
         labels = {
           app = var.project_name
         }
+        annotations = {
+          "prometheus.io/scrape" = "true"
+          "prometheus.io/port"   = "9100"
+          "prometheus.io/path"   = "/metrics"
+        }
       }
 
       spec {
@@ -526,6 +580,12 @@ resource "kubernetes_deployment" "app" {
             protocol       = "TCP"
           }
 
+          port {
+            name           = "metrics"
+            container_port = 9100
+            protocol       = "TCP"
+          }
+
           command = ["gunicorn", "--bind", "0.0.0.0:${var.app_port}", "app:app"]
 
           env {
@@ -588,25 +648,45 @@ resource "kubernetes_deployment" "app" {
             value = var.weather_api_key
           }
 
+          # Fingerprinted assets are fetched from CloudFront instead of the pods
+          dynamic "env" {
+            for_each = var.enable_asset_cdn ? [1] : []
+            content {
+              name  = "ASSET_BASE_URL"
+              value = "https://${aws_cloudfront_distribution.assets[0].domain_name}/static/dist/"
+            }
+          }
+
+          # History rows spooled during database outages survive container restarts
+          env {
+            name  = "SPOOL_DIR"
+            value = "/var/spool/weather-app"
+          }
+
+          volume_mount {
+            name       = "history-spool"
+            mount_path = "/var/spool/weather-app"
+          }
+
           liveness_probe {
             http_get {
-              path = "/"
+              path = "/livez"
               port = var.app_port
             }
-            initial_delay_seconds = 120
-            period_seconds        = 30
-            timeout_seconds       = 60
+            initial_delay_seconds = 30
+            period_seconds        = 10
+            timeout_seconds       = 5
             failure_threshold     = 3
           }
 
           readiness_probe {
             http_get {
-              path = "/"
+              path = "/readyz"
               port = var.app_port
             }
-            initial_delay_seconds = 60
-            period_seconds        = 30
-            timeout_seconds       = 60
+            initial_delay_seconds = 10
+            period_seconds        = 10
+            timeout_seconds       = 5
             failure_threshold     = 3
           }
 
@@ -621,9 +701,20 @@ resource "kubernetes_deployment" "app" {
             }
           }
         }
+
+        # Exceeding size_limit evicts the pod, so SPOOL_MAX_BYTES (256Mi by
+        # default) stops appends and readiness well before that
+        volume {
+          name = "history-spool"
+          empty_dir {
+            size_limit = "512Mi"
+          }
+        }
       }
     }
   }
+
+  depends_on = [kubernetes_job_v1.migrate]
 }
 
 # ============================================================================
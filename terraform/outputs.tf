@@ -50,6 +50,11 @@ output "app_url" {
   value       = "http://${aws_lb.main.dns_name}"
 }
 
+output "asset_cdn_domain" {
+  description = "CloudFront domain serving static assets (empty unless enable_asset_cdn)"
+  value       = var.enable_asset_cdn ? aws_cloudfront_distribution.assets[0].domain_name : ""
+}
+
 # RDS Outputs
 output "rds_endpoint" {
   description = "RDS instance endpoint"
@@ -317,6 +317,28 @@ variable "alb_enable_deletion_protection" {
   default     = false
 }
 
+# ============================================================================
+# Asset CDN Variables (for cdn.tf)
+# ============================================================================
+
+variable "enable_asset_cdn" {
+  description = "Serve fingerprinted static assets through a CloudFront distribution"
+  type        = bool
+  default     = false
+}
+
+variable "asset_cdn_price_class" {
+  description = "CloudFront price class for the asset distribution"
+  type        = string
+  default     = "PriceClass_100"
+}
+
+variable "asset_cdn_origin_domain" {
+  description = "Domain on the ALB certificate for HTTPS origin requests (empty uses HTTP to the ALB DNS name)"
+  type        = string
+  default     = ""
+}
+
 # ============================================================================
 # Security Variables
 # ============================================================================
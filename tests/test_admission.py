@@ -0,0 +1,43 @@
+"""Queue time is measured from the load balancer's arrival stamp.
+
+Run from the repository root with ``python -m pytest tests``.
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault("SPOOL_ENABLED", "false")
+os.environ.setdefault("RATE_LIMIT_BACKEND", "memory")
+os.environ.setdefault("CITY_LABEL_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # pylint: disable=wrong-import-position,import-error
+from admission import parse_amzn_trace_start  # pylint: disable=wrong-import-position,import-error
+
+
+def trace_id(seconds_ago):
+    return f"1-{int(time.time() - seconds_ago):08x}-0123456789abcdef01234567"
+
+
+def test_parse_amzn_trace_start():
+    assert parse_amzn_trace_start("Root=1-67a1b2c3-0123456789abcdef01234567") == 0x67a1b2c3 + 0.5
+    # The ALB's Self segment wins over a Root the client sent
+    assert parse_amzn_trace_start(
+        "Self=1-67a1b2c4-0123456789abcdef01234567;"
+        "Root=1-00000001-0123456789abcdef01234567;Sampled=1") == 0x67a1b2c4 + 0.5
+    assert parse_amzn_trace_start("Root=1-nothex00-0123") is None
+    assert parse_amzn_trace_start("") is None
+
+
+def test_requests_queued_behind_the_alb_are_shed():
+    client = app.app.test_client()
+    queued = app.ADMISSION_MAX_QUEUE_SECONDS + 5
+
+    shed = client.get("/api/weather", headers={"X-Amzn-Trace-Id": f"Root={trace_id(queued)}"})
+    assert shed.status_code == 503
+
+    # A client's own X-Request-Start does not override the ALB's stamp
+    fresh = client.get("/api/weather", headers={
+        "X-Amzn-Trace-Id": f"Root={trace_id(0)}",
+        "X-Request-Start": f"t={time.time() - queued:.3f}"})
+    assert fresh.status_code == 400
@@ -0,0 +1,46 @@
+"""History search through /api/history and /history/search.
+
+Run from the repository root with ``python -m pytest tests``. No database
+is needed: the history query is replaced with a stub.
+"""
+import os
+import sys
+from datetime import datetime
+
+os.environ.setdefault("SPOOL_ENABLED", "false")
+os.environ.setdefault("RATE_LIMIT_BACKEND", "memory")
+os.environ.setdefault("CITY_LABEL_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # pylint: disable=wrong-import-position,import-error
+import history  # pylint: disable=wrong-import-position,import-error
+
+
+def test_city_added_by_another_worker_is_found(monkeypatch):
+    # A freshly loaded index that has not seen the city yet
+    monkeypatch.setattr(history, "city_index", history.CityIndex(3600))
+    history.city_index.load([(1, "Oslo")])
+    row = (7, "Bergen", "9.0 °C", "Rain", datetime(2026, 10, 19, 6, 0))
+    monkeypatch.setattr(history, "search_history", lambda *args: [row])
+
+    page = history.history_page("Ber", None)
+
+    assert page["cities"] == []
+    assert [result["city"] for result in page["results"]] == ["Bergen"]
+
+
+def test_search_urls_share_one_view(monkeypatch):
+    row = (7, "Bergen", "9.0 °C", "Rain", datetime(2026, 10, 19, 6, 0))
+    monkeypatch.setattr(history, "search_history", lambda *args: [row])
+    monkeypatch.setattr(app, "latest_history_id", lambda: 7)
+    client = app.app.test_client()
+
+    api = client.get("/api/history?prefix=Ber")
+    search = client.get("/history/search?prefix=Ber")
+
+    assert api.status_code == search.status_code == 200
+    assert api.get_json() == search.get_json()
+    assert api.headers["ETag"] == search.headers["ETag"]
+    assert client.get("/history/search?prefix=Ber",
+                      headers={"If-None-Match": search.headers["ETag"]}).status_code == 304
+    assert client.get("/history/search?cursor=bogus").status_code == 400
@@ -0,0 +1,43 @@
+"""The cached homepage must not keep a failed history read.
+
+Run from the repository root with ``python -m pytest tests``. No database
+is needed: the history queries are replaced with stubs.
+"""
+import os
+import sys
+from datetime import datetime
+
+os.environ.setdefault("SPOOL_ENABLED", "false")
+os.environ.setdefault("RATE_LIMIT_BACKEND", "memory")
+os.environ.setdefault("CITY_LABEL_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # pylint: disable=wrong-import-position,import-error
+
+UNAVAILABLE = "History is temporarily unavailable."
+
+
+def test_failed_history_read_is_not_cached(monkeypatch):
+    reads = [None, [("Oslo", "3.0 °C", "Clear", datetime(2026, 10, 19, 6, 0))]]
+    monkeypatch.setattr(app, "latest_history_id", lambda: 5)
+    monkeypatch.setattr(app, "fetch_recent_history", lambda: reads.pop(0))
+    app.render_cache.clear()
+    client = app.app.test_client()
+
+    failed = client.get("/")
+    assert failed.status_code == 200
+    assert UNAVAILABLE in failed.get_data(as_text=True)
+    assert "ETag" not in failed.headers
+
+    # The database is back and no history row was added in between
+    recovered = client.get("/")
+    assert recovered.status_code == 200
+    assert "Oslo" in recovered.get_data(as_text=True)
+    assert UNAVAILABLE not in recovered.get_data(as_text=True)
+    etag = recovered.headers["ETag"]
+
+    revalidated = client.get("/", headers={"If-None-Match": etag})
+    assert revalidated.status_code == 304
+    cached = client.get("/")
+    assert "Oslo" in cached.get_data(as_text=True)
+    assert not reads
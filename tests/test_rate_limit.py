@@ -0,0 +1,58 @@
+"""Only weather API calls are charged to a caller's rate limit.
+
+Run from the repository root with ``python -m pytest tests``. No database
+or network is needed: the upstream call, the history insert and the custom
+metrics are stubbed.
+"""
+import os
+import sys
+import time
+
+os.environ.setdefault("SPOOL_ENABLED", "false")
+os.environ.setdefault("RATE_LIMIT_BACKEND", "memory")
+os.environ.setdefault("CITY_LABEL_BACKEND", "memory")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # pylint: disable=wrong-import-position,import-error
+from caches import WeatherCache  # pylint: disable=wrong-import-position,import-error
+from rate_limit import InMemoryBuckets  # pylint: disable=wrong-import-position,import-error
+
+
+class FakeResponse:
+    status_code = 200
+
+    @staticmethod
+    def json():
+        return {"current": {"temp_c": 12.0, "condition": {"text": "Cloudy"},
+                            "last_updated_epoch": int(time.time())}}
+
+
+def test_cache_hits_and_revalidations_are_not_charged(monkeypatch):
+    upstream_calls = []
+
+    def fetch(city):
+        upstream_calls.append(city)
+        return FakeResponse()
+
+    monkeypatch.setattr(app, "rate_limiter", InMemoryBuckets(rate=1 / 3600, burst=2))
+    monkeypatch.setattr(app, "weather_cache", WeatherCache(300, 100))
+    monkeypatch.setattr(app, "fetch_weather_from_api", fetch)
+    monkeypatch.setattr(app, "save_weather_data", lambda *args: None)
+    monkeypatch.setattr(app, "put_custom_metric", lambda *args: None)
+    client = app.app.test_client()
+
+    first = client.get("/api/weather?city=Oslo")
+    assert first.status_code == 200
+    for _ in range(5):
+        assert client.get("/api/weather?city=Oslo").status_code == 200
+        assert client.get("/api/weather?city=Oslo",
+                          headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+    assert client.get("/api/weather?city=Bergen").status_code == 200
+    assert upstream_calls == ["Oslo", "Bergen"]
+
+    limited = client.get("/api/weather?city=Paris")
+    assert limited.status_code == 429
+    assert int(limited.headers["Retry-After"]) > 0
+    assert upstream_calls == ["Oslo", "Bergen"]
+    # Cached cities are still served once the bucket is empty
+    assert client.get("/api/weather?city=Oslo").status_code == 200
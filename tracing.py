@@ -0,0 +1,252 @@
+"""Per-request phase timings and W3C trace context tracing.
+
+Phase timings feed the Server-Timing header and the slow request log.
+Sampled requests also record spans, which SpanExporter writes from a
+background thread.
+"""
+import functools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+import requests
+
+from metrics import TRACES_DROPPED
+
+logger = logging.getLogger(__name__)
+
+# Request tracing. Requests carrying a sampled W3C traceparent are always
+# traced; others are sampled at TRACE_SAMPLE_RATE. Finished traces go to a
+# JSON-lines file and/or an OTLP/HTTP collector.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT")
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "weather-app")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "1000"))
+
+
+class Trace:
+    """Spans recorded for one sampled request."""
+
+    def __init__(self, trace_id, parent_span_id=None):
+        self.trace_id = trace_id
+        self.parent_span_id = parent_span_id
+        self.spans = []
+        self._stack = []
+
+    def start_span(self, name, **attributes):
+        span = {
+            "trace_id": self.trace_id,
+            "kind": "internal" if self.spans else "server",
+            "span_id": os.urandom(8).hex(),
+            "parent_span_id": self._stack[-1]["span_id"] if self._stack else self.parent_span_id,
+            "name": name,
+            "start_time_unix_nano": time.time_ns(),
+            "end_time_unix_nano": None,
+            "attributes": attributes
+        }
+        self.spans.append(span)
+        self._stack.append(span)
+        return span
+
+    def end_span(self, span):
+        span["end_time_unix_nano"] = time.time_ns()
+        if self._stack and self._stack[-1] is span:
+            self._stack.pop()
+
+
+def parse_traceparent(header):
+    """Return ``(trace_id, parent_span_id, sampled)`` from a W3C traceparent."""
+    parts = (header or "").strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16)
+        int(parts[2], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def current_trace():
+    return g.get("trace") if has_request_context() else None
+
+
+@contextmanager
+def trace_span(name, **attributes):
+    """Record a child span of the current request's trace, if it is sampled."""
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    span = trace.start_span(name, **attributes)
+    try:
+        yield span
+    finally:
+        trace.end_span(span)
+
+
+def traced(name):
+    """Decorator recording each call as a span named ``name``."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_phase(name, seconds):
+    """Add ``seconds`` to this request's total for phase ``name``."""
+    if has_request_context():
+        timings = g.setdefault("phase_timings", {})
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def timed_phase(name):
+    """Time a block and attribute it to a phase of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - start)
+
+
+def server_timing_header(timings, total):
+    """Format phase timings (seconds) as a Server-Timing header value."""
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def trace_exemplar():
+    """Exemplar linking a histogram observation to the current trace."""
+    trace = current_trace()
+    return {"trace_id": trace.trace_id} if trace is not None else None
+
+
+class SpanExporter:
+    """Write finished traces from a background thread.
+
+    Traces are queued by the request thread and written as JSON lines to
+    ``path`` and/or POSTed as OTLP/JSON to ``otlp_endpoint``. A full queue
+    drops the trace rather than slowing the request down.
+    """
+
+    def __init__(self, path, otlp_endpoint, max_queue):
+        self.path = path
+        self.otlp_endpoint = otlp_endpoint
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path or self.otlp_endpoint)
+
+    def export(self, spans):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._thread = threading.Thread(
+                        target=self._run, name='span-exporter', daemon=True
+                    )
+                    self._thread.start()
+                    self._pid = os.getpid()
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            TRACES_DROPPED.inc()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 100:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            spans = [span for trace in batch for span in trace]
+            try:
+                if self.path:
+                    with open(self.path, 'a', encoding='utf-8') as handle:
+                        for span in spans:
+                            handle.write(json.dumps(span, separators=(',', ':')) + '\n')
+                if self.otlp_endpoint:
+                    requests.post(self.otlp_endpoint, json=otlp_payload(spans), timeout=5)
+            except (OSError, requests.RequestException) as err:
+                logger.error("Failed to export %d spans: %s", len(spans), err)
+
+
+def otlp_payload(spans):
+    """Convert recorded spans into an OTLP/JSON ExportTraceServiceRequest."""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [
+                {"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}
+            ]},
+            "scopeSpans": [{
+                "scope": {"name": __name__},
+                "spans": [
+                    {
+                        "traceId": span["trace_id"],
+                        "spanId": span["span_id"],
+                        "parentSpanId": span["parent_span_id"] or "",
+                        "name": span["name"],
+                        "kind": 2 if span["kind"] == "server" else 1,
+                        "startTimeUnixNano": str(span["start_time_unix_nano"]),
+                        "endTimeUnixNano": str(span["end_time_unix_nano"]),
+                        "attributes": [
+                            {"key": key, "value": {"stringValue": str(value)}}
+                            for key, value in span["attributes"].items()
+                        ]
+                    }
+                    for span in spans
+                ]
+            }]
+        }]
+    }
+
+
+span_exporter = SpanExporter(TRACE_EXPORT_PATH, TRACE_OTLP_ENDPOINT, TRACE_QUEUE_SIZE)
+
+
+def start_trace():
+    """Start a trace for this request if it is sampled."""
+    parent = parse_traceparent(request.headers.get("traceparent"))
+    if parent is not None:
+        trace_id, parent_span_id, sampled = parent
+    else:
+        trace_id, parent_span_id = os.urandom(16).hex(), None
+        sampled = TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+    if not sampled:
+        return
+    g.trace = Trace(trace_id, parent_span_id)
+    g.trace.start_span(f"{request.method} {request.path}",
+                       method=request.method, path=request.path)
+
+
+def finish_trace(response):
+    """Close the request's root span and hand the trace to the exporter."""
+    trace = g.pop("trace", None)
+    if trace is None:
+        return
+    root = trace.spans[0]
+    root["attributes"]["endpoint"] = request.endpoint or 'unknown'
+    root["attributes"]["status_code"] = response.status_code
+    trace.end_span(root)
+    response.headers["traceparent"] = f"00-{trace.trace_id}-{root['span_id']}-01"
+    if span_exporter.enabled:
+        span_exporter.export(trace.spans)
@@ -0,0 +1,229 @@
+"""Calls to the weatherapi.com current-conditions API.
+
+Concurrent calls are held to an adaptive (AIMD) limit per worker, and the
+idempotent GET is retried with backoff inside the request's deadline while
+a retry budget allows.
+"""
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+
+from admission import time_left
+from metrics import (
+    API_RESPONSE_TIME, UPSTREAM_ATTEMPTS, UPSTREAM_CONCURRENCY_LIMIT, UPSTREAM_LIMIT_CHANGES,
+    UPSTREAM_RETRIES_SKIPPED, UPSTREAM_SHED
+)
+from tracing import timed_phase, trace_exemplar, trace_span, traced
+
+logger = logging.getLogger(__name__)
+
+API_KEY = os.getenv("WEATHER_API_KEY")
+BASE_URL = "http://api.weatherapi.com/v1/current.json"
+
+# Adaptive (AIMD) limit on concurrent weather API calls per worker. Calls
+# slower than the latency target, failures and 5xx shrink the limit.
+UPSTREAM_LIMIT_INITIAL = int(os.getenv("UPSTREAM_LIMIT_INITIAL", "20"))
+UPSTREAM_LIMIT_MIN = int(os.getenv("UPSTREAM_LIMIT_MIN", "2"))
+UPSTREAM_LIMIT_MAX = int(os.getenv("UPSTREAM_LIMIT_MAX", "200"))
+UPSTREAM_LATENCY_TARGET = float(os.getenv("UPSTREAM_LATENCY_TARGET", "2.0"))
+UPSTREAM_QUEUE_SECONDS = float(os.getenv("UPSTREAM_QUEUE_SECONDS", "2.0"))
+
+# Retries of the (idempotent) weather API GET: exponential backoff with full
+# jitter inside an overall deadline, and retries capped at a fraction of calls
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3"))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", "0.1"))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", "2.0"))
+UPSTREAM_ATTEMPT_TIMEOUT = float(os.getenv("UPSTREAM_ATTEMPT_TIMEOUT", "10"))
+UPSTREAM_DEADLINE_SECONDS = float(os.getenv("UPSTREAM_DEADLINE_SECONDS", "15"))
+UPSTREAM_RETRY_BUDGET = float(os.getenv("UPSTREAM_RETRY_BUDGET", "0.1"))
+UPSTREAM_RETRY_BUDGET_MAX = float(os.getenv("UPSTREAM_RETRY_BUDGET_MAX", "10"))
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+
+
+class UpstreamOverloaded(requests.RequestException):
+    """Raised instead of calling the weather API when no slot frees up in time."""
+
+
+class AdaptiveLimiter:
+    """AIMD limit on concurrent calls to the weather provider.
+
+    The limit grows by one after a call that finished within
+    ``latency_target`` while at least half of the limit was in use, and is
+    multiplied by ``backoff`` after a slow or failed call. Only calls that
+    started after the previous decrease can shrink it again, so one burst of
+    slow responses counts once. Callers over the limit wait up to
+    ``queue_timeout`` for a slot, then get UpstreamOverloaded.
+    """
+
+    def __init__(self, initial, min_limit, max_limit, latency_target,
+                 queue_timeout, backoff=0.9):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.queue_timeout = queue_timeout
+        self.backoff = backoff
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        UPSTREAM_CONCURRENCY_LIMIT.set(int(self.limit))
+
+    def acquire(self):
+        """Take a slot and return the token to pass to release()."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.in_flight < int(self.limit),
+                                       timeout=self.queue_timeout):
+                UPSTREAM_SHED.inc()
+                raise UpstreamOverloaded("Too many concurrent weather API calls")
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, token, ok):
+        """Free the slot taken at ``token`` and adapt to how the call went."""
+        now = time.monotonic()
+        with self._cond:
+            self.in_flight -= 1
+            previous = int(self.limit)
+            if not ok or now - token > self.latency_target:
+                if token >= self._last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.backoff)
+                    self._last_decrease = now
+            elif self.in_flight * 2 >= self.limit:
+                self.limit = min(self.max_limit, self.limit + 1)
+            current = int(self.limit)
+            if current != previous:
+                UPSTREAM_CONCURRENCY_LIMIT.set(current)
+                UPSTREAM_LIMIT_CHANGES.labels(
+                    direction='increase' if current > previous else 'decrease').inc()
+            self._cond.notify()
+
+
+upstream_limiter = AdaptiveLimiter(UPSTREAM_LIMIT_INITIAL, UPSTREAM_LIMIT_MIN, UPSTREAM_LIMIT_MAX,
+                                   UPSTREAM_LATENCY_TARGET, UPSTREAM_QUEUE_SECONDS)
+
+
+class RetryBudget:
+    """Allow retries for at most ``ratio`` of calls, per process.
+
+    Every call deposits ``ratio`` of a token (up to ``max_tokens``) and
+    every retry spends a whole one, so during an outage the retries stop
+    once the savings are gone instead of multiplying the load.
+    """
+
+    def __init__(self, ratio, max_tokens):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+retry_budget = RetryBudget(UPSTREAM_RETRY_BUDGET, UPSTREAM_RETRY_BUDGET_MAX)
+
+
+def attempt_outcome(response=None, error=None):
+    """Label value for UPSTREAM_ATTEMPTS."""
+    if isinstance(error, requests.Timeout):
+        return 'timeout'
+    if isinstance(error, requests.ConnectionError):
+        return 'connection_error'
+    if error is not None:
+        return 'error'
+    if response.status_code >= 500:
+        return 'server_error'
+    if response.status_code >= 400:
+        return 'client_error'
+    return 'success'
+
+
+def fetch_attempt(params, timeout):
+    """One upstream GET, counted against the adaptive concurrency limit."""
+    token = upstream_limiter.acquire()
+    start_time = time.time()
+    ok = False
+    try:
+        with timed_phase('upstream'):
+            response = requests.get(BASE_URL, params=params, timeout=timeout)
+        api_duration = time.time() - start_time
+        API_RESPONSE_TIME.observe(api_duration, exemplar=trace_exemplar())
+        ok = response.status_code < 500
+        return response
+    finally:
+        upstream_limiter.release(token, ok)
+
+
+@traced('fetch_weather_from_api')
+def fetch_weather_from_api(city):
+    """Fetch weather data from external API.
+
+    Connection errors, timeouts and 5xx answers are retried up to
+    UPSTREAM_MAX_ATTEMPTS times while the deadline and the retry budget
+    allow; the last response is returned or the last error raised.
+    """
+    params = {"key": API_KEY, "q": city}
+    deadline = time.monotonic() + time_left(UPSTREAM_DEADLINE_SECONDS)
+    retry_budget.deposit()
+    attempt = 1
+    while True:
+        response, error = None, None
+        timeout = min(UPSTREAM_ATTEMPT_TIMEOUT, deadline - time.monotonic())
+        if timeout <= 0:
+            raise requests.Timeout("Request deadline exceeded before calling the weather API")
+        try:
+            with trace_span('upstream_attempt', attempt=attempt):
+                response = fetch_attempt(params, timeout)
+        except UpstreamOverloaded:
+            UPSTREAM_ATTEMPTS.labels(outcome='shed').inc()
+            raise
+        except requests.RequestException as err:
+            error = err
+        UPSTREAM_ATTEMPTS.labels(outcome=attempt_outcome(response, error)).inc()
+        if error is None and response.status_code not in RETRYABLE_STATUS_CODES:
+            return response
+
+        # Full jitter: sleep anywhere up to the capped exponential backoff
+        delay = random.uniform(0, min(UPSTREAM_BACKOFF_MAX,
+                                      UPSTREAM_BACKOFF_BASE * 2 ** (attempt - 1)))
+        give_up = attempt >= UPSTREAM_MAX_ATTEMPTS
+        if not give_up:
+            skipped = None
+            if time.monotonic() + delay >= deadline:
+                skipped = 'deadline'
+            elif not retry_budget.withdraw():
+                skipped = 'budget'
+            if skipped is not None:
+                UPSTREAM_RETRIES_SKIPPED.labels(reason=skipped).inc()
+                give_up = True
+        if give_up:
+            if error is not None:
+                logger.error("Weather API error: %s", error)
+                raise error
+            return response
+        logger.warning("Retrying weather API call (attempt %d) after %s", attempt + 1,
+                       error or f"status {response.status_code}")
+        time.sleep(delay)
+        attempt += 1
+
+
+def probe_weather_api():
+    try:
+        response = requests.get(BASE_URL, params={"key": API_KEY, "q": "London"}, timeout=5)
+    except requests.RequestException as err:
+        # The exception text includes the request URL, and with it the API key
+        raise RuntimeError(f"upstream request failed: {type(err).__name__}") from None
+    if response.status_code != 200:
+        raise RuntimeError(f"upstream returned HTTP {response.status_code}")